@@ -68,7 +68,10 @@ def main():
     if args.load:
 
         # Check if CCPimage object exists and whether overwrite has been set
+        # (stations loaded in batches are prepared at the same time)
         load_file = Path('CCP_load.pkl')
+        if args.batch is not None:
+            load_file = Path('CCP_prep.pkl')
         if load_file.is_file() and not args.ovr:
             ccpfile = open(load_file, "rb")
             ccpimage = pickle.load(ccpfile)
@@ -184,7 +187,27 @@ def main():
 
                 ccpimage.add_rfstream(rfRstream)
 
-            if len(ccpimage.radialRF) > 0:
+                # Prepare each batch of stations and release its streams
+                if args.batch is not None and \
+                        len(ccpimage.radialRF) == args.batch:
+                    ccpimage.prep_data(f1=args.f1, f2ps=args.f2ps,
+                                       f2pps=args.f2pps, f2pss=args.f2pss,
+                                       nbaz=args.nbaz, nslow=args.nslow,
+                                       nproc=args.nproc, path='CCP_PREP',
+                                       kernels='CCP_kernels.pkl')
+
+            if args.batch is not None:
+                if len(ccpimage.radialRF) > 0:
+                    ccpimage.prep_data(f1=args.f1, f2ps=args.f2ps,
+                                       f2pps=args.f2pps, f2pss=args.f2pss,
+                                       nbaz=args.nbaz, nslow=args.nslow,
+                                       nproc=args.nproc, path='CCP_PREP',
+                                       kernels='CCP_kernels.pkl')
+                if ccpimage.is_ready_for_prestack:
+                    ccpimage.save("CCP_prep.pkl")
+                    print()
+                    print("CCPimage saved to 'CCP_prep.pkl'")
+            elif len(ccpimage.radialRF) > 0:
                 ccpimage.save("CCP_load.pkl")
                 ccpimage.is_ready_for_prep = True
                 print()
@@ -194,7 +217,7 @@ def main():
     else:
         pass
 
-    if args.prep:
+    if args.prep and args.batch is None:
 
         prep_file = Path("CCP_prep.pkl")
         if prep_file.is_file() and not args.ovr:
@@ -225,7 +248,9 @@ def main():
                 ccpfile.close()
                 ccpimage.prep_data(f1=args.f1, f2ps=args.f2ps,
                                    f2pps=args.f2pps, f2pss=args.f2pss,
-                                   nbaz=args.nbaz, nslow=args.nslow)
+                                   nbaz=args.nbaz, nslow=args.nslow,
+                                   nproc=args.nproc,
+                                   kernels='CCP_kernels.pkl')
                 ccpimage.is_ready_for_prestack = True
                 ccpimage.save(prep_file)
                 print()
@@ -256,7 +281,15 @@ def main():
                 ccpfile = open(prep_file, 'rb')
                 ccpimage = pickle.load(ccpfile)
                 ccpfile.close()
-                ccpimage.prestack()
+
+                # Project onto a new profile if specified, otherwise onto
+                # the profile defined when loading the data
+                if args.coord_start is not None and \
+                        args.coord_end is not None:
+                    ccpimage = ccpimage.prestack(
+                        profiles=[[args.coord_start, args.coord_end]])[0]
+                else:
+                    ccpimage.prestack()
                 ccpimage.save(prestack_file)
                 print()
                 print("CCPimage saved to {0}".format(str(prestack_file)))
@@ -340,7 +373,7 @@ def main():
                 ccpfile = open(prestack_file, 'rb')
                 ccpimage = pickle.load(ccpfile)
                 ccpfile.close()
-                ccpimage.gccp(wlen=args.wlen)
+                ccpimage.gccp(wlen=args.wlen, zlen=args.zlen)
                 if args.linear:
                     if args.weights:
                         ccpimage.weights = args.weights
@@ -26,11 +26,13 @@
 # Import modules and functions
 import numpy as np
 import pickle
+import time
 import stdb
 from obspy.clients.fdsn import Client
 from obspy.core import Stream, UTCDateTime
 from rfpy import arguments, binning, plotting
 from rfpy import Harmonics
+from rfpy.harmonics import dcomp_batch
 from pathlib import Path
 
 
@@ -68,6 +70,10 @@ def main():
         stkeys = db.keys()
         sorted(stkeys)
 
+    # Harmonics objects and loading times of all stations (with --batch)
+    batch = {}
+    timing = {}
+
     # Loop over station keys
     for stkey in list(stkeys):
 
@@ -125,6 +131,8 @@ def main():
             sta.enddate.strftime("%Y-%m-%d %H:%M:%S")))
         print("|-----------------------------------------------|")
 
+        t0 = time.time()
+
         rfRstream = Stream()
         rfTstream = Stream()
 
@@ -199,14 +207,22 @@ def main():
         # Initialize the HkStack object
         harmonics = Harmonics(rfRstream, rfTstream)
 
+        # Decompose all stations at once after loading them
+        if args.batch:
+            batch[stkey] = harmonics
+            timing[stkey] = time.time() - t0
+            continue
+
         # Stack with or without dip
         if args.find_azim:
-            harmonics.dcomp_find_azim(xmin=args.trange[0], xmax=args.trange[1])
+            harmonics.dcomp_find_azim(xmin=args.trange[0], xmax=args.trange[1],
+                                      robust=args.robust)
             print("Optimal azimuth for trange between " +
                   str(args.trange[0])+" and "+str(args.trange[1]) +
                   "is: "+str(harmonics.azim))
         else:
-            harmonics.dcomp_fix_azim(azim=args.azim)
+            harmonics.dcomp_fix_azim(azim=args.azim, robust=args.robust)
+        print("Station processed in {0:.2f} s".format(time.time() - t0))
 
         if args.plot:
             harmonics.plot(args.ymax, args.scale,
@@ -217,6 +233,47 @@ def main():
                                    ".harmonics.pkl")
             harmonics.save()
 
+    if args.batch and len(batch) > 0:
+
+        # Decompose all stations in one batched call
+        t0 = time.time()
+        if args.find_azim:
+            dcomp_batch(list(batch.values()), find_azim=True,
+                        xmin=args.trange[0], xmax=args.trange[1],
+                        robust=args.robust)
+        else:
+            dcomp_batch(list(batch.values()), azim=args.azim,
+                        robust=args.robust)
+        tbatch = time.time() - t0
+
+        print()
+        print("|-----------------------------------------------|")
+        print("|  Station     # RFs   Azimuth   Load time (s)   |")
+        print("|-----------------------------------------------|")
+        for stkey, harmonics in batch.items():
+            print("|  {0:10s} {1:6d} {2:9.1f} {3:15.2f}   |".format(
+                stkey, len(harmonics.radialRF), harmonics.azim,
+                timing[stkey]))
+        print("|-----------------------------------------------|")
+        print("|  Decomposed {0:4d} stations in {1:8.2f} s        |".format(
+            len(batch), tbatch))
+        print("|-----------------------------------------------|")
+
+        if args.plot:
+            for stkey, harmonics in batch.items():
+                harmonics.plot(args.ymax, args.scale,
+                               args.save_plot, args.title, args.form)
+
+        # Save all stations to a single file
+        if args.save:
+            savepath = Path('HARMONICS_DATA')
+            if not savepath.is_dir():
+                print('Path to '+str(savepath)+' doesn`t exist - creating it')
+                savepath.mkdir()
+            file = open(savepath / "harmonics.pkl", "wb")
+            pickle.dump(batch, file)
+            file.close()
+
 
 if __name__ == "__main__":
 
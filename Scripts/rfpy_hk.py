@@ -211,14 +211,15 @@ def main():
         print("Number of radial RF data: " + str(len(rfRstream)))
         print('')
 
-        # Try binning if specified
+        # Try binning if specified (incremental stacks are updated with
+        # individual receiver functions)
         if args.calc_dip:
             rf_tmp = binning.bin_baz_slow(rfRstream,
                                           nbaz=args.nbaz+1,
                                           nslow=args.nslow+1, 
                                           pws=args.pws)
             rfRstream = rf_tmp[0]
-        else:
+        elif not args.incremental:
             rf_tmp = binning.bin(rfRstream,
                                  typ='slow',
                                  nbin=args.nslow+1, 
@@ -231,11 +232,14 @@ def main():
             rfRstream_copy.filter('bandpass', freqmin=args.bp_copy[0],
                                   freqmax=args.bp_copy[1], corners=2,
                                   zerophase=True)
+        else:
+            rfRstream_copy = None
 
         # Check bin counts:
-        for tr in rfRstream:
-            if (tr.stats.nbin < args.binlim):
-                rfRstream.remove(tr)
+        if not args.incremental:
+            for tr in rfRstream:
+                if (tr.stats.nbin < args.binlim):
+                    rfRstream.remove(tr)
 
         # Continue if stream is too short
         if len(rfRstream) < 5:
@@ -253,13 +257,27 @@ def main():
                          freqmax=args.bp[1], corners=2,
                          zerophase=True)
 
+        if args.save:
+            filename = savepath / (sta.station + \
+                ".hkstack."+args.typ+".pkl")
+
+        # Load previously saved incremental stacks
+        update = args.incremental and filename.is_file() and not args.ovr
+        if update:
+            file = open(filename, "rb")
+            hkstack = pickle.load(file)
+            file.close()
+
         # Initialize the HkStack object
-        try:
-            hkstack = HkStack(rfRstream, rfV2=rfRstream_copy,
-                              strike=args.strike, dip=args.dip, vp=args.vp)
-        except:
-            hkstack = HkStack(rfRstream,
-                              strike=args.strike, dip=args.dip, vp=args.vp)
+        else:
+            try:
+                hkstack = HkStack(rfRstream, rfV2=rfRstream_copy,
+                                  strike=args.strike, dip=args.dip,
+                                  vp=args.vp)
+            except:
+                hkstack = HkStack(rfRstream,
+                                  strike=args.strike, dip=args.dip,
+                                  vp=args.vp)
 
         # Update attributes
         hkstack.hbound = args.hbound
@@ -268,11 +286,22 @@ def main():
         hkstack.dk = args.dk
         hkstack.weights = args.weights
 
+        # Add new and remove missing receiver functions, with the crustal
+        # Vp that stack() would use (a change triggers a full restack)
+        if update:
+            try:
+                hkstack.vp = rfRstream[0].stats.vp
+            except:
+                hkstack.vp = args.vp
+            hkstack.update_traces(rfRstream, rfV2=rfRstream_copy)
+        elif args.incremental:
+            hkstack.stack_incremental()
+
         # Stack with or without dip
-        if args.calc_dip:
-            hkstack.stack_dip()
+        elif args.calc_dip:
+            hkstack.stack_dip(adaptive=args.adaptive, ncoarse=args.ncoarse)
         else:
-            hkstack.stack()
+            hkstack.stack(adaptive=args.adaptive, ncoarse=args.ncoarse)
 
         # Average stacks
         hkstack.average(typ=args.typ)
@@ -281,9 +310,6 @@ def main():
             hkstack.plot(args.save_plot, args.title, args.form)
 
         if args.save:
-            filename = savepath / (hkstack.rfV1[0].stats.station + \
-                ".hkstack."+args.typ+".pkl")
-
             hkstack.save(file=filename)
 
 
@@ -853,6 +853,36 @@ def get_hk_arguments(argv=None):
         dest="dk",
         default=0.02,
         help="Specify search interval for k. [Default 0.02]")
+    HKGroup.add_argument(
+        "--adaptive",
+        action="store_true",
+        dest="adaptive",
+        default=False,
+        help="Set this option to search the H-k grid from a coarse grid " +
+        "refined around the stack maxima at the resolution of --dh " +
+        "and --dk, instead of evaluating every node. [Default False]")
+    HKGroup.add_argument(
+        "--ncoarse",
+        action="store",
+        type=int,
+        dest="ncoarse",
+        default=4,
+        help="Specify the decimation factor of the coarse grid used " +
+        "with --adaptive. [Default 4]")
+    HKGroup.add_argument(
+        "--incremental",
+        action="store_true",
+        dest="incremental",
+        default=False,
+        help="Set this option to update the saved HkStack object of " +
+        "each station with receiver functions added or removed since the " +
+        "last run, instead of restacking all of them. Receiver functions " +
+        "are stacked individually (without binning) and the object is " +
+        "always saved, along with the samples of every receiver function " +
+        "on the H-k grid (about 60 kB per receiver function at the " +
+        "default grid, such that the file keeps growing with the number " +
+        "of receiver functions). Only available for a flat Moho. " +
+        "[Default False]")
     HKGroup.add_argument(
         "--weights",
         action="store",
@@ -1064,6 +1094,16 @@ def get_hk_arguments(argv=None):
                 "Error: --weights should contain 3 " +
                 "comma-separated floats")
 
+    if args.incremental:
+        if args.calc_dip:
+            parser.error(
+                "Error: --incremental is only available for a flat Moho")
+        args.save = True
+
+    if args.ncoarse < 1:
+        parser.error(
+            "Error: --ncoarse should be a positive integer")
+
     return args
 
 
@@ -1215,6 +1255,22 @@ def get_harmonics_arguments(argv=None):
         help="Specify a list of two floats with minimum and maximum" +
         "bounds on time range for finding the optimal azimuth (sec). " +
         "[Default [0., 10.] when '--find-azim' is set]")
+    HarmonicGroup.add_argument(
+        "--robust",
+        action="store_true",
+        dest="robust",
+        default=False,
+        help="Set this option to down-weight outlier receiver functions " +
+        "in the decomposition with iteratively reweighted least squares. " +
+        "[Default uses equal weights]")
+    HarmonicGroup.add_argument(
+        "--batch",
+        action="store_true",
+        dest="batch",
+        default=False,
+        help="Set this option to load all stations first and decompose " +
+        "them in a single batched call, saving all results to a single " +
+        "file with '--save'. [Default decomposes stations one at a time]")
     HarmonicGroup.add_argument(
         "--save",
         action="store_true",
@@ -1507,6 +1563,26 @@ def get_ccp_arguments(argv=None):
         default=40,
         help="Specify integer number of slowness bins to consider. " +
         "[Default 40]")
+    PreGroup.add_argument(
+        "--nproc",
+        action="store",
+        dest="nproc",
+        type=int,
+        default=1,
+        help="Specify integer number of processes over which to " +
+        "distribute the stations during the preparation step. " +
+        "[Default 1]")
+    PreGroup.add_argument(
+        "--batch",
+        action="store",
+        dest="batch",
+        type=int,
+        default=None,
+        help="Specify integer number of stations to load and prepare " +
+        "at a time, in which case the prepared data are written in " +
+        "chunks to the folder 'CCP_PREP' to limit memory usage. " +
+        "Chunks of a previous run in 'CCP_PREP' are replaced. " +
+        "Requires --load and --prep. [Default None]")
     PreGroup.add_argument(
         "--wlen",
         action="store",
@@ -1515,6 +1591,14 @@ def get_ccp_arguments(argv=None):
         default=35.,
         help="Specify wavelength of P-wave as sensitivity (km). " +
         "[Default 35.]")
+    PreGroup.add_argument(
+        "--zlen",
+        action="store",
+        dest="zlen",
+        type=float,
+        default=0.,
+        help="Specify width of the Gaussian function used to smooth " +
+        "the GCCP images in the vertical direction (km). [Default 0.]")
     PreGroup.add_argument(
         "--phase",
         action="store",
@@ -1661,7 +1745,7 @@ def get_ccp_arguments(argv=None):
 
     if args.load and args.coord_start is None:
         parser.error("--start=lon,lat is required")
-    elif args.load and args.coord_start is not None:
+    elif args.coord_start is not None:
         args.coord_start = [float(val) for val in args.coord_start.split(',')]
         if (len(args.coord_start)) != 2:
             parser.error(
@@ -1670,7 +1754,7 @@ def get_ccp_arguments(argv=None):
 
     if args.load and args.coord_end is None:
         parser.error("--end=lon,lat is required")
-    elif args.load and args.coord_end is not None:
+    elif args.coord_end is not None:
         args.coord_end = [float(val) for val in args.coord_end.split(',')]
         if (len(args.coord_end)) != 2:
             parser.error(
@@ -1687,6 +1771,18 @@ def get_ccp_arguments(argv=None):
         parser.error(
             "Error: cannot use --linear and --pws at the same time")
 
+    if args.nproc < 1:
+        parser.error(
+            "Error: --nproc should be a positive integer")
+
+    if args.batch is not None:
+        if args.batch < 1:
+            parser.error(
+                "Error: --batch should be a positive integer")
+        if not (args.load and args.prep):
+            parser.error(
+                "Error: --batch requires both --load and --prep")
+
     if args.ccp and not args.linear and not args.pws:
         args.linear = True
     if args.gccp and not args.linear and not args.pws:
@@ -31,6 +31,9 @@ import numpy as np
 from obspy.core import Stream, Trace
 from scipy.signal import hilbert
 
+# Range of slowness values (s/km) spanned by the bins of bin_baz_slow
+SLOW_BOUNDS = [0.04, 0.08]
+
 
 def bin(stream1, stream2=None, typ='baz', nbin=36+1, pws=False):
     """ 
@@ -174,7 +177,7 @@ def bin_baz_slow(stream1, stream2=None, nbaz=36+1, nslow=20+1, pws=False):
 
     # Define back-azimuth and slowness bins
     baz_bins = np.linspace(0, 360, nbaz)
-    slow_bins = np.linspace(0.04, 0.08, nslow)
+    slow_bins = slowness_bins(nslow)
 
     # Extract baz and slowness
     baz = [stream1[i].stats.baz for i in range(len(stream1))]
@@ -236,6 +239,25 @@ def bin_baz_slow(stream1, stream2=None, nbaz=36+1, nslow=20+1, pws=False):
 
     return final_stream
 
+def slowness_bins(nslow=20+1):
+    """
+    Function to obtain the slowness bins of :func:`~rfpy.binning.bin_baz_slow`
+
+    Parameters
+    ----------
+    nslow : int
+        Number of slowness samples in bins
+
+    Returns
+    -------
+    slow_bins : :class:`~numpy.ndarray`
+        Slowness values of the bin edges (s/km)
+
+    """
+
+    return np.linspace(SLOW_BOUNDS[0], SLOW_BOUNDS[1], nslow)
+
+
 def bin_all(stream1, stream2=None, pws=False):
     """ 
     Function to bin all streams into a single trace.
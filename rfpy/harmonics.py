@@ -26,7 +26,8 @@ Harmonic decomposition module.
 
 # Import modules and functions
 import numpy as np
-from obspy.core import Stream, Trace
+from obspy.core import Stream, Trace, Stats
+from rfpy import utils
 import matplotlib.pyplot as plt
 
 
@@ -51,12 +52,13 @@ class Harmonics(object):
 
     Parameters
     ----------
-    radialRF : :class:`~obspy.core.Stream`
+    radialRF : :class:`~obspy.core.Stream` or :class:`~numpy.ndarray`
         Stream object containing the radial-component receiver function
-        seismograms 
-    transvRF : :class:`~obspy.core.Stream`
+        seismograms, or matrix of receiver functions along the rows (e.g.,
+        migrated to depth with :func:`~rfpy.ccp.migrate`)
+    transvRF : :class:`~obspy.core.Stream` or :class:`~numpy.ndarray`
         Stream object containing the transverse-component receiver function
-        seismograms 
+        seismograms, or matrix of receiver functions along the rows
     azim : float
         Direction (azimuth) along which the B1 component of the stream
         is minimized (between ``xmin`` and ``xmax``)
@@ -64,6 +66,12 @@ class Harmonics(object):
         Minimum x axis value over which to calculate ``azim``
     xmax : float
         Maximum x axis value over which to calculate ``azim``
+    baz : :class:`~numpy.ndarray`
+        Back-azimuth of each row of the receiver function matrices (only
+        used with matrix input)
+    dx : float
+        Sampling interval of the receiver function matrices, in time or
+        depth (only used with matrix input)
 
     Other Parameters
     ----------------
@@ -76,10 +84,11 @@ class Harmonics(object):
 
     """
 
-    def __init__(self, radialRF, transvRF=None, azim=0, xmin=0., xmax=10.):
+    def __init__(self, radialRF, transvRF=None, azim=0, xmin=0., xmax=10.,
+                 baz=None, dx=None):
 
         # Load example data if initializing empty object
-        if radialRF == 'demo' or radialRF == 'Demo':
+        if isinstance(radialRF, str) and radialRF in ['demo', 'Demo']:
             print("Uploading demo data - station NY.MMPY")
             import os
             import pickle
@@ -90,11 +99,27 @@ class Harmonics(object):
             transvRF = pickle.load(file)
             file.close()
 
-        if not transvRF:
+        if transvRF is None or len(transvRF) == 0:
             raise TypeError("__init__() missing 1 required positional argument: 'transvRF'")
 
+        # Receiver functions already in matrix form
+        if isinstance(radialRF, np.ndarray):
+            radialRF = np.asarray(radialRF, dtype=float)
+            transvRF = np.asarray(transvRF, dtype=float)
+            if not radialRF.shape == transvRF.shape:
+                raise(Exception("Radial and transverse matrices have a " +
+                                "different shape"))
+            if baz is None or dx is None:
+                raise(Exception("'baz' and 'dx' must be specified for " +
+                                "receiver function matrices"))
+            if not len(baz) == len(radialRF):
+                raise(Exception("'baz' should have one value per row of " +
+                                "the receiver function matrices"))
+            self.baz = np.asarray(baz, dtype=float)
+            self.dx = dx
+
         # fftshift if the time axis starts at negative lags 
-        if radialRF[0].stats.taxis[0]<0.:
+        elif radialRF[0].stats.taxis[0]<0.:
             for tr in radialRF:
                 tr.data = np.fft.fftshift(tr.data)
             for tr in transvRF:
@@ -106,12 +131,15 @@ class Harmonics(object):
         self.xmin = xmin
         self.xmax = xmax
 
-    def dcomp_find_azim(self, xmin=None, xmax=None):
+    def dcomp_find_azim(self, xmin=None, xmax=None, daz=0.1, weights=None,
+                        robust=False, niter=10, cutoff=2.):
         """
         Method to decompose radial and transverse receiver function 
         streams into back-azimuth harmonics and determine the main 
         orientation ``azim``, obtained by minimizing the B1 component
-        between ``xmin`` and ``xmax`` (i.e., time or depth).
+        between ``xmin`` and ``xmax`` (i.e., time or depth). The harmonics
+        are obtained once along azimuth 0, and rotated analytically to
+        each candidate azimuth.
 
         Parameters
         ----------
@@ -119,6 +147,19 @@ class Harmonics(object):
             Minimum x axis value over which to calculate ``azim``
         xmax : float
             Maximum x axis value over which to calculate ``azim``
+        daz : float
+            Azimuth increment of the search (degrees)
+        weights : :class:`~numpy.ndarray`
+            Weight of each receiver function, applied to both the radial
+            and transverse component (default is equal weights)
+        robust : bool
+            Whether or not to down-weight outlier receiver functions by
+            iteratively reweighted least squares
+        niter : int
+            Maximum number of reweighting iterations (if ``robust=True``)
+        cutoff : float
+            Robust z-score of the residuals of a receiver function above
+            which it is down-weighted (if ``robust=True``)
 
         Attributes
         ----------
@@ -126,115 +167,31 @@ class Harmonics(object):
             Stream containing the 5 harmonics, oriented in direction ``azim``
         azim : float
             Direction (azimuth) along which the B1 component of the stream
-            is minimized (between ``xmin`` and ``xmax``)
+            is minimized (between ``xmin`` and ``xmax``), in the range
+            [0, 180) degrees
         var : :class:`~numpy.ndarray`
             Variance of the 5 harmonics between ``xmin`` and ``xmax``
+        weights : :class:`~numpy.ndarray`
+            Final weight of each receiver function in the decomposition
 
         """
 
-        if not xmin:
+        if xmin is None:
             xmin = self.xmin
-        if not xmax:
+        if xmax is None:
             xmax = self.xmax
 
         print()
         print('Decomposing receiver functions into baz harmonics')
 
-        # Some integers
-        nbin = len(self.radialRF)
-        nz = len(self.radialRF[0].data)
-        naz = 180
-        daz = np.float(360/naz)
-        deg2rad = np.pi/180.
-
-        # Define depth range over which to calculate azimuth
-        indmin = int(xmin/self.radialRF[0].stats.delta)
-        indmax = int(xmax/self.radialRF[0].stats.delta)
-
-        # Copy stream stats
-        str_stats = self.radialRF[0].stats
-
-        # Initialize work arrays
-        C0 = np.zeros((nz, naz))
-        C1 = np.zeros((nz, naz))
-        C2 = np.zeros((nz, naz))
-        C3 = np.zeros((nz, naz))
-        C4 = np.zeros((nz, naz))
-
-        # Loop over each depth step
-        for iz in range(nz):
-
-            # Build matrices OBS and H for each azimuth
-            for iaz in range(naz):
-
-                # Initialize work arrays
-                OBS = np.zeros(2*nbin)
-                H = np.zeros((2*nbin, 5))
-
-                azim = iaz*daz
-
-                # Radial component
-                for irow, trace in enumerate(self.radialRF):
-
-                    baz = trace.stats.baz
-                    OBS[irow] = trace.data[iz]
-                    H[irow, 0] = 1.0
-                    H[irow, 1] = np.cos(deg2rad*(baz-azim))
-                    H[irow, 2] = np.sin(deg2rad*(baz-azim))
-                    H[irow, 3] = np.cos(2.*deg2rad*(baz-azim))
-                    H[irow, 4] = np.sin(2.*deg2rad*(baz-azim))
-
-                shift = 90.
-
-                # Transverse component
-                for irow, trace in enumerate(self.transvRF):
-
-                    baz = trace.stats.baz
-                    OBS[irow+nbin] = trace.data[iz]
-                    H[irow+nbin, 0] = 0.0
-                    H[irow+nbin, 1] = np.cos(deg2rad*(baz+shift-azim))
-                    H[irow+nbin, 2] = np.sin(deg2rad*(baz+shift-azim))
-                    H[irow+nbin, 3] = np.cos(2.*deg2rad*(baz+shift/2.0-azim))
-                    H[irow+nbin, 4] = np.sin(2.*deg2rad*(baz+shift/2.0-azim))
-
-                # Solve system of equations with truncated SVD
-                u, s, v = np.linalg.svd(H)
-                s[s < 0.001] = 0.
-                CC = np.linalg.solve(s[:, None] * v, u.T.dot(OBS)[:5])
-
-                # Fill up arrays
-                C0[iz, iaz] = np.float(CC[0])
-                C1[iz, iaz] = np.float(CC[1])
-                C2[iz, iaz] = np.float(CC[2])
-                C3[iz, iaz] = np.float(CC[3])
-                C4[iz, iaz] = np.float(CC[4])
-
-        # Minimize variance of third component over specific depth range to
-        # find azim
-        C1var = np.zeros(naz)
-        for iaz in range(naz):
-            C1var[iaz] = np.sqrt(np.mean(np.square(C1[indmin:indmax, iaz])))
-        indaz = np.argmin(C1var)
-
-        C0var = np.sqrt(np.mean(np.square(C0[indmin:indmax, indaz])))
-        C1var = np.sqrt(np.mean(np.square(C1[indmin:indmax, indaz])))
-        C2var = np.sqrt(np.mean(np.square(C2[indmin:indmax, indaz])))
-        C3var = np.sqrt(np.mean(np.square(C3[indmin:indmax, indaz])))
-        C4var = np.sqrt(np.mean(np.square(C4[indmin:indmax, indaz])))
-
-        # Put back into traces
-        A = Trace(data=C0[:, indaz], header=str_stats)
-        B1 = Trace(data=C1[:, indaz], header=str_stats)
-        B2 = Trace(data=C2[:, indaz], header=str_stats)
-        C1 = Trace(data=C3[:, indaz], header=str_stats)
-        C2 = Trace(data=C4[:, indaz], header=str_stats)
+        # Solve for all depth steps at once along azimuth 0
+        CC0 = self._solve(0., weights, robust, niter, cutoff)
 
-        # Put all treaces into stream
-        self.hstream = Stream(traces=[A, B1, B2, C1, C2])
-        self.azim = indaz*daz
-        self.var = [C0var, C1var, C2var, C3var, C4var]
+        # Search for the optimal azimuth and rotate harmonics
+        self._find_azim(CC0, xmin, xmax, daz)
 
-    def dcomp_fix_azim(self, azim=None):
+    def dcomp_fix_azim(self, azim=None, weights=None, robust=False, niter=10,
+                       cutoff=2.):
         """
         Method to decompose radial and transverse receiver function 
         streams into back-azimuth harmonics along direction ``azim``.
@@ -244,11 +201,24 @@ class Harmonics(object):
         azim : float
             Direction (azimuth) along which the B1 component of the stream
             is minimized (between ``xmin`` and ``xmax``)
+        weights : :class:`~numpy.ndarray`
+            Weight of each receiver function, applied to both the radial
+            and transverse component (default is equal weights)
+        robust : bool
+            Whether or not to down-weight outlier receiver functions by
+            iteratively reweighted least squares
+        niter : int
+            Maximum number of reweighting iterations (if ``robust=True``)
+        cutoff : float
+            Robust z-score of the residuals of a receiver function above
+            which it is down-weighted (if ``robust=True``)
 
         Attributes
         ----------
         hstream : :class:`~obspy.core.Stream`
             Stream containing the 5 harmonics, oriented in direction ``azim``
+        weights : :class:`~numpy.ndarray`
+            Final weight of each receiver function in the decomposition
 
         """
 
@@ -260,73 +230,114 @@ class Harmonics(object):
         print('Decomposing receiver functions into baz harmonics for azimuth = ',
               azim)
 
-        # Some integers
+        # Solve system of equations with truncated SVD for all depth steps
+        CC = self._solve(azim, weights, robust, niter, cutoff)
+
+        # Put back into traces
+        self._set_hstream(CC)
+
+    def bootstrap(self, nboot=200, method='bootstrap', q=0.05, nproc=1,
+                  seed=None):
+        """
+        Method to estimate confidence bands on the 5 harmonic components
+        along direction ``azim`` by resampling the receiver functions. The
+        design matrix and observations are built once, and each resample
+        only reweights their rows, such that all resamples are obtained
+        from batched least-squares solves. The weights of the last
+        decomposition (e.g., ``robust=True``) are kept in the resamples.
+
+        Parameters
+        ----------
+        nboot : int
+            Number of bootstrap resamples (ignored if ``method='jackknife'``,
+            where each receiver function is left out in turn)
+        method : str
+            Resampling method. Options are ``method='bootstrap'`` (random
+            draws with replacement) or ``method='jackknife'`` (leave-one-out)
+        q : float
+            Confidence level for the confidence bands
+        nproc : int
+            Number of processes over which to distribute the resamples
+        seed : int
+            Seed of the random number generator, for reproducible draws
+
+        Attributes
+        ----------
+        boot_harmonics : :class:`~numpy.ndarray`
+            Harmonic components of all resamples (shape ``nboot, 5, nz``)
+        err_harmonics : :class:`~numpy.ndarray`
+            Standard errors of the harmonic components (shape ``5, nz``)
+        ci_harmonics : :class:`~numpy.ndarray`
+            Lower and upper bounds of the ``1 - q`` confidence bands on the
+            harmonic components (shape ``2, 5, nz``)
+
+        """
+
+        if method not in ['bootstrap', 'jackknife']:
+            raise(Exception("'method' must be either 'bootstrap' or " +
+                            "'jackknife'"))
+        if len(self.radialRF) != len(self.transvRF):
+            raise(Exception("Radial and transverse streams should have " +
+                            "the same number of receiver functions"))
+
+        # Build matrices OBS and H once
+        OBS = _observations(self.radialRF, self.transvRF)
+        H = _design_matrix(*self._baz(), self.azim)
         nbin = len(self.radialRF)
-        nz = len(self.radialRF[0].data)
-        deg2rad = np.pi/180.
 
-        # Copy stream stats
-        str_stats = self.radialRF[0].stats
-
-        # Initialize work arrays
-        C0 = np.zeros(nz)
-        C1 = np.zeros(nz)
-        C2 = np.zeros(nz)
-        C3 = np.zeros(nz)
-        C4 = np.zeros(nz)
-
-        # Loop over each depth step
-        for iz in range(nz):
-
-            # Initialize working arrays
-            OBS = np.zeros(2*nbin)
-            H = np.zeros((2*nbin, 5))
-
-            # Radial component
-            for irow, trace in enumerate(self.radialRF):
-
-                baz = trace.stats.baz
-                OBS[irow] = trace.data[iz]
-                H[irow, 0] = 1.0
-                H[irow, 1] = np.cos(deg2rad*(baz-azim))
-                H[irow, 2] = np.sin(deg2rad*(baz-azim))
-                H[irow, 3] = np.cos(2.*deg2rad*(baz-azim))
-                H[irow, 4] = np.sin(2.*deg2rad*(baz-azim))
-
-            shift = 90.
-
-            # Transverse component
-            for irow, trace in enumerate(self.transvRF):
-
-                baz = trace.stats.baz
-                OBS[irow+nbin] = trace.data[iz]
-                H[irow+nbin, 0] = 0.0
-                H[irow+nbin, 1] = np.cos(deg2rad*(baz+shift-azim))
-                H[irow+nbin, 2] = np.sin(deg2rad*(baz+shift-azim))
-                H[irow+nbin, 3] = np.cos(2.*deg2rad*(baz+shift/2.0-azim))
-                H[irow+nbin, 4] = np.sin(2.*deg2rad*(baz+shift/2.0-azim))
-
-            # Solve system of equations with truncated SVD
-            u, s, v = np.linalg.svd(H)
-            s[s < 0.001] = 0.
-            CC = np.linalg.solve(s[:, None] * v, u.T.dot(OBS)[:5])
-
-            # Fill up arrays
-            C0[iz] = np.float(CC[0])
-            C1[iz] = np.float(CC[1])
-            C2[iz] = np.float(CC[2])
-            C3[iz] = np.float(CC[3])
-            C4[iz] = np.float(CC[4])
+        # Number of times each receiver function is drawn in each resample
+        idx = utils.resample_indices(nbin, nboot, method, seed)
+        counts = np.array([np.bincount(sel, minlength=nbin) for sel in idx])
 
-        # Put back into traces
-        A = Trace(data=C0, header=str_stats)
-        B1 = Trace(data=C1, header=str_stats)
-        B2 = Trace(data=C2, header=str_stats)
-        C1 = Trace(data=C3, header=str_stats)
-        C2 = Trace(data=C4, header=str_stats)
+        # Keep the weights of a weighted or robust decomposition
+        if hasattr(self, 'weights') and len(self.weights) == nbin:
+            counts = counts*self.weights
 
-        # Put all traces into stream
-        self.hstream = Stream(traces=[A, B1, B2, C1, C2])
+        chunks = np.array_split(counts, max(1, min(nproc, len(counts))))
+        CC = np.concatenate(list(utils.pool_imap(
+            _boot_worker, chunks, nproc, {'H': H, 'OBS': OBS})))
+
+        err, ci = utils.resample_errors(CC, nbin, method, q)
+
+        self.boot_method = method
+        self.boot_harmonics = CC
+        self.err_harmonics = err
+        self.ci_harmonics = ci
+
+    def predict(self, baz_list):
+        """
+        Method to predict radial and transverse component receiver functions
+        given the 5 pre-determined harmonics, for a batch of back-azimuth
+        values at once. The predictions are obtained as a single matrix
+        product of the harmonics with the design matrix of the back-azimuths.
+
+        Parameters
+        ----------
+        baz_list : list or :class:`~numpy.ndarray`
+            Back-azimuth directions over which to calculate the receiver
+            functions
+
+        Returns
+        -------
+        radial : :class:`~numpy.ndarray`
+            Radial receiver functions (shape ``nbaz, nz``)
+        transv : :class:`~numpy.ndarray`
+            Transverse receiver functions (shape ``nbaz, nz``)
+
+        """
+
+        if not hasattr(self, 'hstream'):
+            raise(Exception("Decomposition has not been performed yet"))
+
+        baz_list = np.atleast_1d(np.asarray(baz_list, dtype=float))
+        nbaz = len(baz_list)
+
+        # Calculate product B = H*X for all back-azimuths and time steps
+        X = np.array([tr.data for tr in self.hstream])
+        H = _design_matrix(baz_list, baz_list, self.azim)
+        B = H.dot(X)
+
+        return B[:nbaz], B[nbaz:]
 
     def forward(self, baz_list=None):
         """
@@ -357,65 +368,25 @@ class Harmonics(object):
         if not hasattr(self, 'hstream'):
             raise(Exception("Decomposition has not been performed yet"))
 
-        if not baz_list:
+        if baz_list is None:
             print("Warning: no BAZ specified - using all baz from " +
                   "stored streams")
-            baz_list = [tr.stats.baz for tr in self.radialRF]
-        if not isinstance(baz_list, list):
-            baz_list = [baz_list]
+            baz_list = self._baz()[0]
+        baz_list = np.atleast_1d(np.asarray(baz_list, dtype=float))
 
-        # Some constants
-        nz = len(self.hstream[0].data)
-        deg2rad = np.pi/180.
+        radial, transv = self.predict(baz_list)
 
-        # Copy traces
+        # Put into traces
         self.radial_forward = Stream()
         self.transv_forward = Stream()
-
-        for baz in baz_list:
-            trR = Trace(header=self.hstream[0].stats)
-            trT = Trace(header=self.hstream[0].stats)
-
-            # Loop over each time/depth step
-            for iz in range(nz):
-
-                # Initialize working arrays
-                X = np.zeros(5)
-                H = np.zeros((2, 5))
-
-                # Fill up X array
-                X[0] = hstream[0].data[iz]
-                X[1] = hstream[1].data[iz]
-                X[2] = hstream[2].data[iz]
-                X[3] = hstream[3].data[iz]
-                X[4] = hstream[4].data[iz]
-
-                # Fill up H arrays (for V and H)
-                H[0, 0] = 1.0
-                H[0, 1] = np.cos(deg2rad*(baz-self.azim))
-                H[0, 2] = np.sin(deg2rad*(baz-self.azim))
-                H[0, 3] = np.cos(2.*deg2rad*(baz-self.azim))
-                H[0, 4] = np.sin(2.*deg2rad*(baz-self.azim))
-
-                shift = 90.
-
-                H[1, 0] = 0.0
-                H[1, 1] = np.cos(deg2rad*(baz+shift-self.azim))
-                H[1, 2] = np.sin(deg2rad*(baz+shift-self.azim))
-                H[1, 3] = np.cos(2.*deg2rad*(baz+shift/2.0-self.azim))
-                H[1, 4] = np.sin(2.*deg2rad*(baz+shift/2.0-self.azim))
-
-                # Calculate dot product B = H*X
-                B = np.dot(H, X)
-
-                # Extract receiver functions
-                trR.data[iz] = B[0]
-                trT.data[iz] = -B[1]
-
+        for baz, dataR, dataT in zip(baz_list, radial, transv):
+            trR = Trace(data=dataR, header=self.hstream[0].stats.copy())
+            trT = Trace(data=dataT, header=self.hstream[0].stats.copy())
+            trR.stats.baz = baz
+            trT.stats.baz = baz
             self.radial_forward.append(trR)
             self.transv_forward.append(trT)
 
-
     def plot(self, ymax=30., scale=10., save=False, title=None, form='png'):
         """
         Method to plot the 5 harmonic components.
@@ -463,6 +434,13 @@ class Harmonics(object):
                 facecolor='red',
                 linewidth=0)
 
+            # Confidence bands, if available
+            if hasattr(self, 'ci_harmonics'):
+                ax1.plot(i+1+self.ci_harmonics[0, i]*scale, y,
+                         c='grey', lw=0.5)
+                ax1.plot(i+1+self.ci_harmonics[1, i]*scale, y,
+                         c='grey', lw=0.5)
+
         ax1.set_ylim(ymax, 0)
         ax1.set_xlabel('Harmonic components')
         if title:
@@ -484,6 +462,122 @@ class Harmonics(object):
                         bbox_inches='tight', format=form)
         plt.show()
 
+    def _find_azim(self, CC0, xmin, xmax, daz):
+        """
+        Search for the azimuth ``azim`` minimizing the B1 component of the
+        harmonics ``CC0`` obtained along azimuth 0 between ``xmin`` and
+        ``xmax``, and store the harmonics rotated to that azimuth.
+
+        """
+
+        # Candidate azimuths. The rotated B1 component only changes sign
+        # between ``azim`` and ``azim + 180``, such that searching over
+        # [0, 180) avoids picking either half by round-off
+        azims = np.round(np.arange(0., 180., daz), 6)
+
+        # Define depth range over which to calculate azimuth
+        indmin = int(xmin/self._stats().delta)
+        indmax = int(xmax/self._stats().delta)
+
+        # Minimize variance of third component over specific depth range to
+        # find azim. The rotated B1 component is a linear combination of
+        # the B1 and B2 components along azimuth 0, such that its mean 
+        # square only requires their second moments
+        B1 = CC0[1, indmin:indmax]
+        B2 = CC0[2, indmin:indmax]
+        cosaz = np.cos(np.pi/180.*azims)
+        sinaz = np.sin(np.pi/180.*azims)
+        B1var = np.sqrt(np.maximum(
+            np.mean(B1*B1)*cosaz**2 + 2.*np.mean(B1*B2)*cosaz*sinaz +
+            np.mean(B2*B2)*sinaz**2, 0.))
+        indaz = np.argmin(B1var)
+
+        # Rotate harmonics to the optimal azimuth
+        CC = _rotate(CC0, azims[indaz])
+        C0var, C1var, C2var, C3var, C4var = np.sqrt(
+            np.mean(np.square(CC[:, indmin:indmax]), axis=1))
+
+        self._set_hstream(CC)
+        self.azim = azims[indaz]
+        self.var = [C0var, C1var, C2var, C3var, C4var]
+
+    def _set_hstream(self, CC):
+        """
+        Put the 5 harmonics ``CC`` (along the rows) into the stream
+        ``hstream``
+
+        """
+
+        # Copy stream stats
+        str_stats = self._stats()
+
+        # Put back into traces
+        A = Trace(data=CC[0], header=str_stats)
+        B1 = Trace(data=CC[1], header=str_stats)
+        B2 = Trace(data=CC[2], header=str_stats)
+        C1 = Trace(data=CC[3], header=str_stats)
+        C2 = Trace(data=CC[4], header=str_stats)
+
+        # Put all traces into stream
+        self.hstream = Stream(traces=[A, B1, B2, C1, C2])
+
+    def _solve(self, azim, weights, robust, niter, cutoff):
+        """
+        Solve for the 5 harmonics along ``azim`` for all depth steps at
+        once, either by (weighted) least squares or by iteratively
+        reweighted least squares (see ``_irls_solve``).
+
+        """
+
+        # Build matrices OBS and H, with one column of OBS per depth step
+        OBS = _observations(self.radialRF, self.transvRF)
+        H = _design_matrix(*self._baz(), azim)
+        nbin = len(self.radialRF)
+
+        if weights is None and not robust:
+            self.weights = np.ones(nbin)
+            return _tsvd_solve(H, OBS)
+
+        if len(self.radialRF) != len(self.transvRF):
+            raise(Exception("Radial and transverse streams should have " +
+                            "the same number of receiver functions"))
+        if weights is None:
+            weights = np.ones(nbin)
+        weights = np.asarray(weights, dtype=float)
+        if not len(weights) == nbin:
+            raise(Exception("'weights' should have one value per " +
+                            "receiver function"))
+
+        CC, w = _irls_solve(H[None], OBS[None], weights[None],
+                            np.ones((1, nbin), dtype=bool), robust, niter,
+                            cutoff)
+
+        self.weights = w[0]
+        return CC[0]
+
+    def _baz(self):
+        """
+        Back-azimuths of the radial and transverse receiver functions
+
+        """
+
+        if isinstance(self.radialRF, np.ndarray):
+            return self.baz, self.baz
+        return ([tr.stats.baz for tr in self.radialRF],
+                [tr.stats.baz for tr in self.transvRF])
+
+    def _stats(self):
+        """
+        Header of the harmonic component traces, taken from the first
+        receiver function or from the sampling of the matrices
+
+        """
+
+        if isinstance(self.radialRF, np.ndarray):
+            return Stats({'delta': self.dx,
+                          'npts': self.radialRF.shape[1]})
+        return self.radialRF[0].stats
+
     def save(self, file):
         """
         Saves harmonics object to file
@@ -499,3 +593,273 @@ class Harmonics(object):
         output = open(file, 'wb')
         pickle.dump(self, output)
         output.close()
+
+
+def dcomp_batch(harmonics, azim=None, find_azim=False, xmin=None,
+                xmax=None, daz=0.1, weights=None, robust=False, niter=10,
+                cutoff=2.):
+    """
+    Function to decompose the receiver functions of several stations into
+    back-azimuth harmonics at once. The observations and design matrices of
+    all stations are padded to the same size and stacked, such that the
+    (weighted or robust) decompositions of all stations are obtained from
+    the same batched least-squares solves. The results are the same as
+    calling :func:`~rfpy.harmonics.Harmonics.dcomp_fix_azim` or
+    :func:`~rfpy.harmonics.Harmonics.dcomp_find_azim` on each object.
+
+    Parameters
+    ----------
+    harmonics : list
+        List of :class:`~rfpy.harmonics.Harmonics` objects, one per station
+    azim : float
+        Direction (azimuth) along which to decompose all stations (default
+        is the ``azim`` attribute of each object). Ignored if ``find_azim``
+    find_azim : bool
+        Whether or not to search for the optimal azimuth of each station
+        (see :func:`~rfpy.harmonics.Harmonics.dcomp_find_azim`)
+    xmin : float
+        Minimum x axis value over which to calculate ``azim``
+    xmax : float
+        Maximum x axis value over which to calculate ``azim``
+    daz : float
+        Azimuth increment of the search (degrees)
+    weights : list
+        Weights of the receiver functions of each station (default is equal
+        weights)
+    robust : bool
+        Whether or not to down-weight outlier receiver functions by
+        iteratively reweighted least squares
+    niter : int
+        Maximum number of reweighting iterations (if ``robust=True``)
+    cutoff : float
+        Robust z-score of the residuals of a receiver function above
+        which it is down-weighted (if ``robust=True``)
+
+    """
+
+    nsta = len(harmonics)
+    if weights is None:
+        weights = [None]*nsta
+    if not len(weights) == nsta:
+        raise(Exception("'weights' should have one array per station"))
+
+    for h in harmonics:
+        if len(h.radialRF) != len(h.transvRF):
+            raise(Exception("Radial and transverse streams should have " +
+                            "the same number of receiver functions"))
+
+    nbin = [len(h.radialRF) for h in harmonics]
+    nz = [h._stats().npts for h in harmonics]
+    maxbin = max(nbin)
+
+    # Stack padded matrices of all stations, with radial receiver functions
+    # in the first maxbin rows and transverse ones in the last maxbin rows
+    H = np.zeros((nsta, 2*maxbin, 5))
+    OBS = np.zeros((nsta, 2*maxbin, max(nz)))
+    W = np.zeros((nsta, maxbin))
+    valid = np.zeros((nsta, maxbin), dtype=bool)
+    for i, h in enumerate(harmonics):
+        n = nbin[i]
+        if find_azim:
+            az = 0.
+        else:
+            if azim is not None:
+                h.azim = azim
+            az = h.azim
+        Hi = _design_matrix(*h._baz(), az)
+        OBSi = _observations(h.radialRF, h.transvRF)
+        H[i, :n] = Hi[:n]
+        H[i, maxbin:maxbin + n] = Hi[n:]
+        OBS[i, :n, :nz[i]] = OBSi[:n]
+        OBS[i, maxbin:maxbin + n, :nz[i]] = OBSi[n:]
+        if weights[i] is None:
+            W[i, :n] = 1.
+        else:
+            if not len(weights[i]) == n:
+                raise(Exception("'weights' should have one value per " +
+                                "receiver function"))
+            W[i, :n] = weights[i]
+        valid[i, :n] = True
+
+    print()
+    print('Decomposing receiver functions of '+str(nsta) +
+          ' stations into baz harmonics')
+
+    CC, W = _irls_solve(H, OBS, W, valid, robust, niter, cutoff)
+
+    for i, h in enumerate(harmonics):
+        h.weights = W[i, :nbin[i]]
+        if find_azim:
+            h._find_azim(CC[i, :, :nz[i]],
+                         h.xmin if xmin is None else xmin,
+                         h.xmax if xmax is None else xmax, daz)
+        else:
+            h._set_hstream(CC[i, :, :nz[i]])
+
+
+def _boot_worker(counts):
+    """
+    Function to solve for the 5 harmonic components of each resample, given
+    by the number of draws of each receiver function in the rows of
+    ``counts``. Each draw weighs both the radial and transverse rows of the
+    receiver function, and the weighted normal equations are solved at
+    once for all resamples, with the design matrix and observations shared
+    by :func:`~rfpy.utils.pool_imap`.
+
+    """
+
+    return _weighted_solve(utils.SHARED['H'], utils.SHARED['OBS'],
+                           np.hstack((counts, counts)))
+
+
+def _weighted_solve(H, OBS, w):
+    """
+    Solve the weighted systems of equations ``W.H.C = W.OBS`` for a batch
+    of row weights ``w`` (shape ``nbatch, nrows``) and all columns of
+    ``OBS`` at once (the 5 harmonics are along the second axis of the
+    returned array). ``H`` and ``OBS`` are either shared by the batch or
+    given for each system of the batch (shapes ``nbatch, nrows, 5`` and
+    ``nbatch, nrows, nz``). Only the 5 x 5 weighted normal equations are
+    factorized for each system, and their eigenvalues below ``0.001**2``
+    (i.e., singular values of ``W^1/2.H`` below 0.001) are truncated as in
+    the truncated SVD solution.
+
+    """
+
+    w = np.asarray(w, dtype=float)
+
+    # Weighted normal equations H^T.W.H and H^T.W.OBS
+    WH = w[:, :, None]*H
+    HtWH = np.matmul(np.swapaxes(WH, 1, 2), H)
+    HtWO = np.matmul(np.swapaxes(WH, 1, 2), OBS)
+
+    lam, V = np.linalg.eigh(HtWH)
+    laminv = np.zeros(lam.shape)
+    laminv[lam >= 1.e-6] = 1./lam[lam >= 1.e-6]
+
+    # C = V.L^-1.V^T.H^T.W.OBS, for all weights
+    return np.matmul(V*laminv[:, None, :],
+                     np.matmul(np.swapaxes(V, 1, 2), HtWO))
+
+
+def _irls_solve(H, OBS, weights, valid, robust=True, niter=10, cutoff=2.):
+    """
+    Solve for the 5 harmonics of a batch of stations by weighted least
+    squares and, if ``robust``, by iteratively reweighted least squares.
+    The rows of ``H`` and ``OBS`` (shapes ``nbatch, 2*nbin, 5`` and
+    ``nbatch, 2*nbin, nz``) hold the radial then transverse receiver
+    functions, with ``weights`` for each receiver function (shape
+    ``nbatch, nbin``) and padded receiver functions flagged as not
+    ``valid``. Each iteration is a single batched solve, and receiver
+    functions with a robust z-score of their RMS residual above ``cutoff``
+    are down-weighted by ``cutoff/z``.
+
+    """
+
+    nbin = weights.shape[1]
+
+    w = weights
+    CC = _weighted_solve(H, OBS, np.hstack((w, w)))
+    for i in range(niter if robust else 0):
+
+        # RMS residual of each receiver function (both components)
+        res = OBS - np.einsum('brk,bkz->brz', H, CC)
+        rms = np.sqrt(np.mean(res[:, :nbin]**2 + res[:, nbin:]**2, axis=2))
+        rms[~valid] = np.nan
+
+        # Robust z-score of the residuals of each station
+        med = np.nanmedian(rms, axis=1, keepdims=True)
+        mad = 1.4826*np.nanmedian(np.abs(rms - med), axis=1, keepdims=True)
+        z = np.zeros(rms.shape)
+        np.divide(rms - med, mad, out=z, where=valid & (mad > 0.))
+        wnew = weights*np.where(
+            z > cutoff, cutoff/np.maximum(z, cutoff), 1.)
+
+        converged = np.max(np.abs(wnew - w)) < 1.e-3
+        w = wnew
+        CC = _weighted_solve(H, OBS, np.hstack((w, w)))
+        if converged:
+            break
+
+    return CC, w
+
+
+def _observations(radialRF, transvRF):
+    """
+    Matrix of observations, with the radial (first rows) and transverse
+    (last rows) receiver functions along the rows and one column per
+    time or depth step
+
+    """
+
+    if isinstance(radialRF, np.ndarray):
+        return np.vstack((radialRF, transvRF))
+
+    return np.array([tr.data for tr in radialRF] +
+                    [tr.data for tr in transvRF], dtype=float)
+
+
+def _design_matrix(baz_r, baz_t, azim):
+    """
+    Matrix relating the 5 harmonics oriented along ``azim`` to the radial
+    (first rows) and transverse (last rows) receiver functions at
+    back-azimuths ``baz_r`` and ``baz_t``
+
+    """
+
+    deg2rad = np.pi/180.
+    shift = 90.
+
+    baz_r = np.asarray(baz_r, dtype=float)
+    baz_t = np.asarray(baz_t, dtype=float)
+    nbin = len(baz_r)
+    H = np.zeros((nbin + len(baz_t), 5))
+
+    # Radial component
+    H[:nbin, 0] = 1.0
+    H[:nbin, 1] = np.cos(deg2rad*(baz_r-azim))
+    H[:nbin, 2] = np.sin(deg2rad*(baz_r-azim))
+    H[:nbin, 3] = np.cos(2.*deg2rad*(baz_r-azim))
+    H[:nbin, 4] = np.sin(2.*deg2rad*(baz_r-azim))
+
+    # Transverse component
+    H[nbin:, 0] = 0.0
+    H[nbin:, 1] = np.cos(deg2rad*(baz_t+shift-azim))
+    H[nbin:, 2] = np.sin(deg2rad*(baz_t+shift-azim))
+    H[nbin:, 3] = np.cos(2.*deg2rad*(baz_t+shift/2.0-azim))
+    H[nbin:, 4] = np.sin(2.*deg2rad*(baz_t+shift/2.0-azim))
+
+    return H
+
+
+def _rotate(CC, azim):
+    """
+    Rotate the 5 harmonics ``CC`` (along the rows) obtained along azimuth 0
+    to the harmonics along ``azim``. The first- and second-order harmonic
+    pairs are rotated by ``azim`` and twice ``azim``, respectively.
+
+    """
+
+    deg2rad = np.pi/180.
+    c1, s1 = np.cos(deg2rad*azim), np.sin(deg2rad*azim)
+    c2, s2 = np.cos(2.*deg2rad*azim), np.sin(2.*deg2rad*azim)
+
+    return np.array([CC[0],
+                     c1*CC[1] + s1*CC[2],
+                     -s1*CC[1] + c1*CC[2],
+                     c2*CC[3] + s2*CC[4],
+                     -s2*CC[3] + c2*CC[4]])
+
+
+def _tsvd_solve(H, OBS):
+    """
+    Solve the system of equations ``H.C = OBS`` with truncated SVD, for
+    all columns of ``OBS`` at once (the 5 harmonics are along the rows of
+    the returned array)
+
+    """
+
+    u, s, v = np.linalg.svd(H)
+    s[s < 0.001] = 0.
+
+    return np.linalg.solve(s[:, None] * v, u.T.dot(OBS)[:5])
@@ -31,8 +31,10 @@ The stacks are obtained from the median weighted by the phase of individual sign
 import numpy as np
 from obspy.core import Stream, Trace, AttribDict
 from scipy.signal import hilbert
-from scipy import stats
+from scipy import stats, ndimage
 import sys
+from collections import OrderedDict
+from rfpy import utils
 from matplotlib import pyplot as plt
 
 
@@ -87,6 +89,11 @@ class HkStack(object):
     phases : list
         List of 3 strings ('ps', 'pps', 'pss') corresponding to the thre phases
         of interest (`do not modify this attribute`)
+    vpbound : list
+        List of 2 floats that determine the range of crustal Vp values to
+        search with :func:`~rfpy.hk.HkStack.stack_vp`
+    dvp : float
+        Spacing between adjacent Vp search values (km/s)
 
     """
 
@@ -104,14 +111,9 @@ class HkStack(object):
             file.close()
 
         # fftshift if the time axis starts at negative lags
-        if rfV1[0].stats.taxis[0] < 0.:
-            nn = rfV1[0].stats.npts
-            for tr in rfV1:
-                tr.data = np.fft.fftshift(tr.data)[0:int(nn/2)]
-                tr.stats.taxis = np.fft.fftshift(tr.data)[0:int(nn/2)]
-            for tr in rfV2:
-                tr.data = np.fft.fftshift(tr.data)[0:int(nn/2)]
-                tr.stats.taxis = np.fft.fftshift(tr.data)[0:int(nn/2)]
+        _positive_lags(rfV1)
+        if rfV2:
+            _positive_lags(rfV2)
 
         self.rfV1 = rfV1
         self.rfV2 = rfV2
@@ -124,8 +126,10 @@ class HkStack(object):
         self.dh = 0.5
         self.weights = [0.5, 2., -1.]
         self.phases = ['ps', 'pps', 'pss']
+        self.vpbound = [5.6, 6.8]
+        self.dvp = 0.05
 
-    def stack(self, vp=None):
+    def stack(self, vp=None, adaptive=False, ncoarse=4):
         """
         Method to calculate Hk stacks from radial receiver functions.
         The stacks are calculated using phase-weighted stacking for
@@ -145,6 +149,11 @@ class HkStack(object):
         ----------
         vp : float
             Mean crust P-wave velocity (km/s). 
+        adaptive : bool
+            Whether or not to use a coarse-to-fine search instead of
+            evaluating every node of the ``dh``, ``dk`` grid
+        ncoarse : int
+            Decimation factor of the coarse grid for the adaptive search
 
         Attributes
         ----------
@@ -154,6 +163,11 @@ class HkStack(object):
         sig : :class:`~numpy.ndarray`
             Variance of phase stacks, where the outer dimension corresponds
             to the phase index (shape ``nH, nk, nph``)
+        exact : :class:`~numpy.ndarray`
+            Whether the stacks of each (H, k) node are evaluated exactly
+            or interpolated from the coarse grid (shape ``nH, nk``)
+        neval : int
+            Number of nodes evaluated exactly
 
         """
 
@@ -164,54 +178,10 @@ class HkStack(object):
             except:
                 vp = self.vp
 
-        # Station name
-        sta = self.rfV1[0].stats.station
+        self._stack_grid(vp, False, adaptive, ncoarse)
 
-        # Initialize arrays based on bounds
-        H = np.arange(self.hbound[0], self.hbound[1] + self.dh, self.dh)
-        k = np.arange(self.kbound[0], self.kbound[1] + self.dk, self.dk)
-
-        # Initialize arrays
-        weight = np.complex(0.)
-        amp = np.zeros(len(self.rfV1))
-        sig = np.zeros((len(H), len(k), len(self.phases)))
-        pws = np.zeros((len(H), len(k), len(self.phases)))
-
-        for ih in _progressbar(range(len(H)), 'Computing: ', 15):
-            for ik, kk in enumerate(k):
-                for ip, ph in enumerate(self.phases):
-                    for i in range(len(self.rfV1)):
-
-                        if self.rfV2 and (ph == 'pps' or ph == 'pss'):
-                            rfV = self.rfV2[i].copy()
-                        else:
-                            rfV = self.rfV1[i].copy()
-
-                        # Calculate move out for each phase and get
-                        # median value, weighted by instantaneous phase (pws)
-                        tt = _dtime_(rfV, H[ih], kk, vp, ph)
-                        trace = _timeshift_(rfV, tt)
-                        thilb = hilbert(trace)
-                        tphase = np.arctan2(thilb.imag, thilb.real)
-                        weight += np.exp(1j*tphase[0])
-                        amp[i] = trace[0]
-
-                        # ### Attempt at speeding things up
-                        # ind = (np.abs(rfV.stats.taxis - tt)).argmin()
-                        # trace = rfV.copy()
-                        # thilb = hilbert(trace.data)
-                        # tphase = np.arctan2(thilb.imag, thilb.real)
-                        # weight += np.exp(1j*tphase[ind])
-                        # amp[i] = trace.data[ind]
-
-                    weight = abs(weight/len(self.rfV1))**4
-                    sig[ih, ik, ip] = np.var(amp)*np.real(weight)
-                    pws[ih, ik, ip] = np.median(amp)*np.real(weight)
-
-        self.pws = pws
-        self.sig = sig
-
-    def stack_dip(self, vp=None, strike=None, dip=None):
+    def stack_dip(self, vp=None, strike=None, dip=None, adaptive=False,
+                  ncoarse=4):
         """
         Method to calculate Hk stacks from radial receiver functions
         using known stike and dip angles of the Moho.
@@ -237,6 +207,11 @@ class HkStack(object):
             Strike angle of dipping Moho (has to be known or estimated a priori)
         dip : float
             Dip angle of Moho (has to be known or estimated a priori)
+        adaptive : bool
+            Whether or not to use a coarse-to-fine search instead of
+            evaluating every node of the ``dh``, ``dk`` grid
+        ncoarse : int
+            Decimation factor of the coarse grid for the adaptive search
 
         Attributes
         ----------
@@ -246,6 +221,11 @@ class HkStack(object):
         sig : :class:`~numpy.ndarray`
             Variance of phase stacks, where the outer dimension corresponds
             to the phase index (shape ``nH, nk, nph``)
+        exact : :class:`~numpy.ndarray`
+            Whether the stacks of each (H, k) node are evaluated exactly
+            or interpolated from the coarse grid (shape ``nH, nk``)
+        neval : int
+            Number of nodes evaluated exactly
 
         """
 
@@ -265,44 +245,517 @@ class HkStack(object):
             except:
                 vp = 6.0
 
-        sta = self.rfV1[0].stats.station
+        self._stack_grid(vp, True, adaptive, ncoarse)
+
+    def _stack_grid(self, vp, dipping, adaptive, ncoarse, thresh=0.25):
+        """
+        Internal method to evaluate the phase stacks on the H-k grid.
+
+        With ``adaptive=True``, the stacks are first evaluated on a grid
+        decimated by ``ncoarse`` and bilinearly interpolated. Every node
+        where the final stack (either ``typ``) exceeds ``thresh`` times its
+        maximum, dilated by one coarse cell, is then re-evaluated at full
+        resolution, until no such node is left with interpolated values.
+        The maxima and the error contours of ``err_method='amp'`` (at half
+        the maximum) are therefore obtained from exact stack values. The
+        other nodes keep interpolated values, which may differ from the
+        exact ones by a sizeable fraction of the maximum, such that they
+        only serve for display and ``err_method='stats'`` may include some
+        of them in its confidence region. Exact nodes are flagged in the
+        ``exact`` attribute, and their number is stored in ``neval``.
+
+        """
 
         # Initialize arrays based on bounds
         H = np.arange(self.hbound[0], self.hbound[1] + self.dh, self.dh)
         k = np.arange(self.kbound[0], self.kbound[1] + self.dk, self.dk)
 
-        # Initialize arrays
-        weight = np.complex(0.)
-        amp = np.zeros(len(self.rfV1))
         sig = np.zeros((len(H), len(k), len(self.phases)))
         pws = np.zeros((len(H), len(k), len(self.phases)))
 
-        for ih in _progressbar(range(len(H)), 'Computing: ', 15):
-            for ik, kk in enumerate(k):
-                for ip, ph in enumerate(self.phases):
-                    for i in range(len(self.rfV1)):
-
-                        if self.rfV2 and (ph == 'pps' or ph == 'pss'):
-                            rfV = self.rfV2[i].copy()
-                        else:
-                            rfV = self.rfV1[i].copy()
-
-                        # Calculate move out for each phase and get
-                        # median value, weighted by instantaneous phase (pws)
-                        tt = _dtime_dip_(
-                            rfV, H[ih], kk, vp, ph, self.strike, self.dip)
-                        trace = _timeshift_(rfV, tt)
-                        thilb = hilbert(trace)
-                        tphase = np.arctan2(thilb.imag, thilb.real)
-                        weight += np.exp(1j*tphase[0])
-                        amp[i] = trace[0]
-
-                    weight = abs(weight/np.float(len(self.rfV1)))**4
-                    sig[ih, ik, ip] = np.var(amp)*np.real(weight)
-                    pws[ih, ik, ip] = np.median(amp)*np.real(weight)
+        if not adaptive or ncoarse < 2:
+            nodes = [(ih, ik) for ih in range(len(H)) for ik in range(len(k))]
+            for ih, ik in _progressbar(nodes, 'Computing: ', 15):
+                pws[ih, ik], sig[ih, ik] = self._stack_node(
+                    H[ih], k[ik], vp, dipping)
+            self.pws = pws
+            self.sig = sig
+            self.exact = np.ones((len(H), len(k)), dtype=bool)
+            self.neval = len(nodes)
+            return
+
+        # Coarse grid, always including the last node on each axis
+        ihc = np.unique(np.r_[np.arange(0, len(H), ncoarse), len(H) - 1])
+        ikc = np.unique(np.r_[np.arange(0, len(k), ncoarse), len(k) - 1])
+
+        done = np.zeros((len(H), len(k)), dtype=bool)
+        nodes = [(ih, ik) for ih in ihc for ik in ikc]
+        for ih, ik in _progressbar(nodes, 'Coarse grid: ', 15):
+            pws[ih, ik], sig[ih, ik] = self._stack_node(
+                H[ih], k[ik], vp, dipping)
+            done[ih, ik] = True
+
+        pws = _interp_grid(pws, ihc, ikc)
+        sig = _interp_grid(sig, ihc, ikc)
+
+        # Nodes to refine around the maxima of either type of final stack,
+        # repeated with the refined values until all of them are exact
+        w = np.array(self.weights[:len(self.phases)])
+        while True:
+            refine = np.zeros((len(H), len(k)), dtype=bool)
+            for stack in [np.sum(pws*w, axis=2),
+                          np.prod(np.clip(pws*w, 0., None), axis=2)]:
+                if stack.max() > 0.:
+                    refine |= stack >= thresh*stack.max()
+            refine = ndimage.binary_dilation(
+                refine, structure=np.ones((3, 3)), iterations=ncoarse)
+
+            nodes = list(zip(*np.where(refine & ~done)))
+            if len(nodes) == 0:
+                break
+            for ih, ik in _progressbar(nodes, 'Refining: ', 15):
+                pws[ih, ik], sig[ih, ik] = self._stack_node(
+                    H[ih], k[ik], vp, dipping)
+                done[ih, ik] = True
 
         self.pws = pws
         self.sig = sig
+        self.exact = done
+        self.neval = int(done.sum())
+
+    def _stack_node(self, h, kk, vp, dipping=False):
+        """
+        Internal method to calculate the phase-weighted median and variance
+        of all phases at a single (H, k) node.
+
+        """
+
+        pws = np.zeros(len(self.phases))
+        sig = np.zeros(len(self.phases))
+        amp = np.zeros(len(self.rfV1))
+
+        for ip, ph in enumerate(self.phases):
+            weight = 0j
+            for i in range(len(self.rfV1)):
+
+                if self.rfV2 and (ph == 'pps' or ph == 'pss'):
+                    rfV = self.rfV2[i].copy()
+                else:
+                    rfV = self.rfV1[i].copy()
+
+                # Calculate move out for each phase and get
+                # median value, weighted by instantaneous phase (pws)
+                if dipping:
+                    tt = _dtime_dip_(
+                        rfV, h, kk, vp, ph, self.strike, self.dip)
+                else:
+                    tt = _dtime_(rfV, h, kk, vp, ph)
+                trace = _timeshift_(rfV, tt)
+                thilb = hilbert(trace)
+                tphase = np.arctan2(thilb.imag, thilb.real)
+                weight += np.exp(1j*tphase[0])
+                amp[i] = trace[0]
+
+            weight = abs(weight/len(self.rfV1))**4
+            sig[ip] = np.var(amp)*np.real(weight)
+            pws[ip] = np.median(amp)*np.real(weight)
+
+        return pws, sig
+
+    def stack_vp(self, vpbound=None, dvp=None):
+        """
+        Method to calculate joint H-k-Vp stacks from radial receiver
+        functions for a flat Moho. The crustal P-wave velocity is added
+        as a third search dimension, such that the trade-off between
+        Vp and the H-k estimates is quantified in a single pass.
+
+        Note
+        ----
+        The moveout times of all traces and all (H, k) nodes are
+        calculated at once for each Vp value, and the amplitudes and
+        instantaneous phases are obtained from the Fourier coefficients of
+        each trace, rather than by shifting and transforming every trace
+        for every node. The samples are identical to those of
+        :func:`~rfpy.hk.HkStack.stack`. Only the per-trace samples of a
+        single Vp value are held in memory at any time.
+
+        Parameters
+        ----------
+        vpbound : list
+            List of 2 floats that determine the range of Vp values to search.
+            If not specified, the attribute ``vpbound`` is used.
+        dvp : float
+            Spacing between adjacent Vp search values (km/s). If not
+            specified, the attribute ``dvp`` is used.
+
+        Attributes
+        ----------
+        pws_vp : :class:`~numpy.ndarray`
+            Array of phase stacks, where the outer dimension corresponds
+            to the phase index (shape ``nH, nk, nvp, nph``)
+        sig_vp : :class:`~numpy.ndarray`
+            Variance of phase stacks, where the outer dimension corresponds
+            to the phase index (shape ``nH, nk, nvp, nph``)
+
+        """
+
+        if vpbound:
+            self.vpbound = vpbound
+        if dvp:
+            self.dvp = dvp
+
+        # Initialize arrays based on bounds
+        H = np.arange(self.hbound[0], self.hbound[1] + self.dh, self.dh)
+        k = np.arange(self.kbound[0], self.kbound[1] + self.dk, self.dk)
+        vp = np.arange(self.vpbound[0], self.vpbound[1] + self.dvp, self.dvp)
+
+        sig = np.zeros((len(H), len(k), len(vp), len(self.phases)))
+        pws = np.zeros((len(H), len(k), len(vp), len(self.phases)))
+
+        for iv in _progressbar(range(len(vp)), 'Computing: ', 15):
+            amp, phasor = self._moveout_samples(H, k, vp[iv])
+            weight = np.abs(np.mean(phasor, axis=0))**4
+            sig[:, :, iv, :] = np.var(amp, axis=0)*weight
+            pws[:, :, iv, :] = np.median(amp, axis=0)*weight
+
+        self.pws_vp = pws
+        self.sig_vp = sig
+
+    def bootstrap(self, nboot=200, method='bootstrap', typ='sum', q=0.05,
+                  vp=None, nproc=1, seed=None):
+        """
+        Method to estimate the uncertainty on H and k by resampling the
+        receiver functions, for a flat Moho. The per-trace amplitudes and
+        instantaneous phases along the moveout curves are calculated once
+        on the H-k grid, and each resample only recombines these samples
+        into phase-weighted stacks, without re-shifting the traces. The
+        samples are identical to those of :func:`~rfpy.hk.HkStack.stack`,
+        such that the resampled estimates are centred on those of
+        :func:`~rfpy.hk.HkStack.average`.
+
+        Parameters
+        ----------
+        nboot : int
+            Number of bootstrap resamples (ignored if ``method='jackknife'``,
+            where each trace is left out in turn)
+        method : str
+            Resampling method. Options are ``method='bootstrap'`` (random
+            draws with replacement) or ``method='jackknife'`` (leave-one-out)
+        typ : str
+            How the phase-weigthed stacks should be combined to produce
+            a final stack. Available options are: weighted sum (``typ=sum``) 
+            or product (``typ=product``).
+        q : float
+            Confidence level for the confidence intervals
+        vp : float
+            Mean crust P-wave velocity (km/s). 
+        nproc : int
+            Number of processes over which to distribute the resamples
+        seed : int
+            Seed of the random number generator, for reproducible draws
+
+        Attributes
+        ----------
+        boot_h0 : :class:`~numpy.ndarray`
+            Distribution of the H estimates over all resamples
+        boot_k0 : :class:`~numpy.ndarray`
+            Distribution of the k estimates over all resamples
+        boot_err_h0 : float
+            Standard error of H
+        boot_err_k0 : float
+            Standard error of k
+        ci_h0 : list
+            Lower and upper bounds of the ``1 - q`` confidence interval on H
+        ci_k0 : list
+            Lower and upper bounds of the ``1 - q`` confidence interval on k
+
+        """
+
+        if method not in ['bootstrap', 'jackknife']:
+            raise(Exception("'method' must be either 'bootstrap' or " +
+                            "'jackknife'"))
+
+        # Mean crustal P-wave velocity
+        if not vp:
+            try:
+                vp = self.rfV1[0].stats.vp
+            except:
+                vp = self.vp
+
+        # Initialize arrays based on bounds
+        H = np.arange(self.hbound[0], self.hbound[1] + self.dh, self.dh)
+        k = np.arange(self.kbound[0], self.kbound[1] + self.dk, self.dk)
+
+        amp, phasor = self._moveout_samples(H, k, vp)
+        ntr = amp.shape[0]
+
+        # Trace indices of each resample
+        idx = utils.resample_indices(ntr, nboot, method, seed)
+
+        shared = {'amp': amp, 'phasor': phasor, 'weights': self.weights,
+                  'typ': typ}
+        chunks = np.array_split(idx, max(1, min(nproc, len(idx))))
+        ind = np.concatenate(list(utils.pool_imap(
+            _boot_worker, chunks, nproc, shared)))
+
+        h0 = H[ind[:, 0]]
+        k0 = k[ind[:, 1]]
+
+        err, ci = utils.resample_errors(np.column_stack((h0, k0)), ntr,
+                                        method, q)
+
+        self.boot_method = method
+        self.boot_h0 = h0
+        self.boot_k0 = k0
+        self.boot_err_h0 = max(err[0], self.dh)
+        self.boot_err_k0 = max(err[1], self.dk)
+        self.ci_h0 = [float(x) for x in ci[:, 0]]
+        self.ci_k0 = [float(x) for x in ci[:, 1]]
+
+    def _moveout_samples(self, H, k, vp, rfV1=None, rfV2=None):
+        """
+        Internal method to sample the amplitude and unit phasor of the
+        analytic signal of every trace along the moveout curves of all
+        phases, for a flat Moho and all (H, k) nodes at once. Returns
+        two arrays of shape ``(ntr, nH, nk, nph)``. By default the
+        traces are those of the ``rfV1`` and ``rfV2`` attributes.
+
+        """
+
+        if rfV1 is None:
+            rfV1 = self.rfV1
+            rfV2 = self.rfV2
+
+        slow = np.array([tr.stats.slow for tr in rfV1])
+        dt = rfV1[0].stats.delta
+        data1 = np.array([tr.data for tr in rfV1])
+        if rfV2:
+            data2 = np.array([tr.data for tr in rfV2])
+        else:
+            data2 = data1
+
+        shape = (len(slow), len(H), len(k), len(self.phases))
+        amp = np.zeros(shape)
+        phasor = np.zeros(shape, dtype=complex)
+
+        for ip, ph in enumerate(self.phases):
+
+            if ph == 'pps' or ph == 'pss':
+                data = data2
+            else:
+                data = data1
+
+            # Moveout times of shape (ntr, nH, nk)
+            tt = _dtime_grid(slow, H, k, vp, ph)
+            amp[..., ip], tphase = _shift_samples(data, dt, tt)
+            phasor[..., ip] = np.exp(1j*tphase)
+
+        return amp, phasor
+
+    def stack_incremental(self, vp=None):
+        """
+        Method to calculate Hk stacks for a flat Moho while keeping
+        per-trace contributions, such that receiver functions can later
+        be added with :func:`~rfpy.hk.HkStack.add_traces` or removed with
+        :func:`~rfpy.hk.HkStack.remove_traces` without shifting the traces
+        already in the stacks along the moveout curves again.
+
+        Note
+        ----
+        The amplitudes and phases of each trace along the moveout curves
+        are stored (in single precision) along with the running sum of
+        phases, and are saved with the object by
+        :func:`~rfpy.hk.HkStack.save`. Only the moveout samples of the
+        traces that are added are calculated, but the median and variance
+        of the stacks are recalculated from the stored samples of all
+        traces, such that each update still takes a time proportional to
+        the total number of traces (albeit much shorter than a restack).
+        The Vp value used is stored in the ``vp`` attribute, and changing
+        ``hbound``, ``dh``, ``kbound``, ``dk`` or ``vp`` after this call
+        triggers a full restack on the next update.
+
+        Parameters
+        ----------
+        vp : float
+            Mean crust P-wave velocity (km/s). 
+
+        Attributes
+        ----------
+        pws : :class:`~numpy.ndarray`
+            Array of phase stacks, where the outer dimension corresponds
+            to the phase index (shape ``nH, nk, nph``)
+        sig : :class:`~numpy.ndarray`
+            Variance of phase stacks, where the outer dimension corresponds
+            to the phase index (shape ``nH, nk, nph``)
+        keys : list
+            Identifiers (``id.starttime``) of the stacked traces
+
+        """
+
+        # Mean crustal P-wave velocity
+        if not vp:
+            try:
+                vp = self.rfV1[0].stats.vp
+            except:
+                vp = self.vp
+
+        # Initialize arrays based on bounds
+        H = np.arange(self.hbound[0], self.hbound[1] + self.dh, self.dh)
+        k = np.arange(self.kbound[0], self.kbound[1] + self.dk, self.dk)
+
+        amp, phasor = self._moveout_samples(H, k, vp)
+
+        self.vp = vp
+        self._incr = {
+            'grid': [list(self.hbound), self.dh, list(self.kbound),
+                     self.dk, vp],
+            'amp': amp.astype(np.float32),
+            'phasor': phasor.astype(np.complex64),
+            'phasor_sum': np.sum(phasor, axis=0)}
+        self.keys = [_trace_key(tr) for tr in self.rfV1]
+
+        self._update_incremental()
+
+    def add_traces(self, rfV1, rfV2=None):
+        """
+        Method to add receiver functions to incremental Hk stacks
+        calculated with :func:`~rfpy.hk.HkStack.stack_incremental`.
+        Traces already in the stack (same ``id`` and ``starttime``)
+        are ignored.
+
+        Parameters
+        ----------
+        rfV1 : :class:`~obspy.core.Stream`
+            Stream object containing the new radial-component receiver
+            functions
+        rfV2 : :class:`~obspy.core.Stream`
+            Stream object containing the corresponding copies filtered
+            at lower frequencies (required if ``rfV2`` is set)
+
+        """
+
+        self._check_incremental()
+
+        new = [i for i, tr in enumerate(rfV1) if _trace_key(tr) not in
+               self.keys]
+        if len(new) == 0:
+            return
+
+        rfV1 = Stream(traces=[rfV1[i] for i in new])
+        _positive_lags(rfV1)
+        if self.rfV2:
+            if not rfV2:
+                raise(Exception("'rfV2' is required to add traces to " +
+                                "stacks using a second stream"))
+            rfV2 = Stream(traces=[rfV2[i] for i in new])
+            _positive_lags(rfV2)
+        else:
+            rfV2 = None
+
+        vp = self._incr['grid'][4]
+        H = np.arange(self.hbound[0], self.hbound[1] + self.dh, self.dh)
+        k = np.arange(self.kbound[0], self.kbound[1] + self.dk, self.dk)
+        amp, phasor = self._moveout_samples(H, k, vp, rfV1, rfV2)
+
+        self._incr['amp'] = np.concatenate(
+            [self._incr['amp'], amp.astype(np.float32)])
+        self._incr['phasor'] = np.concatenate(
+            [self._incr['phasor'], phasor.astype(np.complex64)])
+        self._incr['phasor_sum'] += np.sum(phasor, axis=0)
+
+        self.rfV1 += rfV1
+        if rfV2:
+            self.rfV2 += rfV2
+        self.keys.extend([_trace_key(tr) for tr in rfV1])
+
+        self._update_incremental()
+
+    def remove_traces(self, keys):
+        """
+        Method to remove receiver functions from incremental Hk stacks
+        calculated with :func:`~rfpy.hk.HkStack.stack_incremental`.
+
+        Parameters
+        ----------
+        keys : list
+            Identifiers (``id.starttime``, see attribute ``keys``) of the
+            traces to remove. Unknown identifiers are ignored.
+
+        """
+
+        self._check_incremental()
+
+        ind = [i for i, key in enumerate(self.keys) if key in keys]
+        if len(ind) == 0:
+            return
+        if len(ind) == len(self.keys):
+            raise(Exception("Cannot remove all traces from the stacks"))
+
+        self._incr['phasor_sum'] -= np.sum(
+            self._incr['phasor'][ind], axis=0)
+        self._incr['amp'] = np.delete(self._incr['amp'], ind, axis=0)
+        self._incr['phasor'] = np.delete(self._incr['phasor'], ind, axis=0)
+
+        for i in ind[::-1]:
+            self.rfV1.remove(self.rfV1[i])
+            if self.rfV2:
+                self.rfV2.remove(self.rfV2[i])
+            del self.keys[i]
+
+        self._update_incremental()
+
+    def update_traces(self, rfV1, rfV2=None):
+        """
+        Method to synchronize incremental Hk stacks with a stream of
+        receiver functions: traces that are no longer in ``rfV1`` are
+        removed and new traces are added.
+
+        Parameters
+        ----------
+        rfV1 : :class:`~obspy.core.Stream`
+            Stream object containing the radial-component receiver
+            functions
+        rfV2 : :class:`~obspy.core.Stream`
+            Stream object containing the corresponding copies filtered
+            at lower frequencies (required if ``rfV2`` is set)
+
+        """
+
+        self._check_incremental()
+
+        keys = [_trace_key(tr) for tr in rfV1]
+        self.remove_traces([key for key in self.keys if key not in keys])
+        self.add_traces(rfV1, rfV2)
+
+    def _check_incremental(self):
+        """
+        Internal method to check that the incremental stacks exist and
+        correspond to the current search grid, and to restack all current
+        traces otherwise.
+
+        """
+
+        if not hasattr(self, '_incr'):
+            raise(Exception("Incremental stacks have not been " +
+                            "calculated yet"))
+
+        grid = [list(self.hbound), self.dh, list(self.kbound), self.dk,
+                self.vp]
+        if self._incr['grid'] != grid:
+            print("Search grid has changed - restacking all traces")
+            self.stack_incremental(vp=self.vp)
+
+    def _update_incremental(self):
+        """
+        Internal method to obtain the phase stacks from the per-trace
+        contributions.
+
+        """
+
+        amp = self._incr['amp']
+        weight = np.abs(self._incr['phasor_sum']/amp.shape[0])**4
+        self.sig = np.var(amp, axis=0, dtype=float)*weight
+        self.pws = np.median(amp, axis=0).astype(float)*weight
 
     def average(self, typ='sum', q=0.05, err_method='amp'):
         """
@@ -435,6 +888,132 @@ class HkStack(object):
         self.err_k0 = max(0.25*(k[max(err[1])] - k[min(err[1])]), self.dk)
         self.err_h0 = max(0.25*(H[max(err[0])] - H[min(err[0])]), self.dh)
 
+    def average_vp(self, typ='sum', q=0.05, err_method='amp'):
+        """
+        Method to combine the joint H-k-Vp phase stacks to produce a final
+        three-dimensional stack, from which to estimate the H, k and Vp
+        parameters and their associated errors.
+
+        Parameters
+        ----------
+        typ : str
+            How the phase-weigthed stacks should be combined to produce
+            a final stack. Available options are: weighted sum (``typ=sum``) 
+            or product (``typ=product``).
+        q : float
+            Confidence level for the error estimate
+        err_method : str
+            How errors should be estimated. Options are ``err_method='amp'``
+            to estimate errors from amplitude, or ``err_method='stats'`` to 
+            use a statistical F test from the residuals.
+
+        Attributes
+        ----------
+        stack3d : :class:`~numpy.ndarray`
+            Final stack (shape ``nH, nk, nvp``)
+        proj_hk : :class:`~numpy.ndarray`
+            Maximum of the final stack projected along the Vp axis
+            (shape ``nH, nk``)
+        proj_hvp : :class:`~numpy.ndarray`
+            Maximum of the final stack projected along the k axis
+            (shape ``nH, nvp``)
+        proj_kvp : :class:`~numpy.ndarray`
+            Maximum of the final stack projected along the H axis
+            (shape ``nk, nvp``)
+
+        """
+
+        if not hasattr(self, 'pws_vp'):
+            raise(Exception("Joint H-k-Vp stacks have not been calculated yet"))
+
+        # Initialize arrays based on bounds
+        H = np.arange(self.hbound[0], self.hbound[1] + self.dh, self.dh)
+        k = np.arange(self.kbound[0], self.kbound[1] + self.dk, self.dk)
+        vp = np.arange(self.vpbound[0], self.vpbound[1] + self.dvp, self.dvp)
+
+        # Get stacks
+        stack = _combine(self.pws_vp, self.weights, typ)
+        self.typ = typ
+
+        # Find maximum within stacks
+        ind = np.unravel_index(np.argmax(stack), stack.shape)
+
+        self.h0 = H[ind[0]]
+        self.k0 = k[ind[1]]
+        self.vp0 = vp[ind[2]]
+        self.stack3d = stack
+
+        # Marginal projections for plotting
+        self.proj_hk = stack.max(axis=2)
+        self.proj_hvp = stack.max(axis=1)
+        self.proj_kvp = stack.max(axis=0)
+
+        try:
+            self.error_vp(q=q, err_method=err_method)
+        except:
+            self.err_k0 = 0.
+            self.err_h0 = 0.
+            self.err_vp0 = 0.
+
+    def error_vp(self, q=0.05, err_method='amp'):
+        """
+        Method to determine the error on H, k and Vp estimates from the
+        joint H-k-Vp stack, following :func:`~rfpy.hk.HkStack.error` with
+        three free parameters.
+
+        Parameters
+        ----------
+        q : float
+            Confidence level for the error estimate
+        err_method : str
+            How errors should be estimated. Options are ``err_method='amp'``
+            to estimate errors from amplitude, or ``err_method='stats'`` to 
+            use a statistical F test from the residuals.
+
+        """
+
+        # Initialize arrays based on bounds
+        H = np.arange(self.hbound[0], self.hbound[1] + self.dh, self.dh)
+        k = np.arange(self.kbound[0], self.kbound[1] + self.dk, self.dk)
+        vp = np.arange(self.vpbound[0], self.vpbound[1] + self.dvp, self.dvp)
+
+        msf = self.stack3d/self.stack3d.max()
+
+        # Method 1 - based on stats
+        if err_method == 'stats':
+
+            # Get degrees of freedom
+            dof = _dof(self._residuals(vp=self.vp0))
+            if dof < 4:
+                dof = 4
+                print(
+                    "Degrees of freedom < 4. Fixing to DOF = 4, which may " +
+                    "result in accurate errors")
+
+            n_par = 3
+            msf = 1. - msf
+
+            # Error contour
+            vmin = msf.min()
+            self.err_contour_vp = vmin*(1. + n_par/(dof - n_par) *
+                                        stats.f.ppf(1. - q, n_par, dof - n_par))
+            err = np.where(msf < self.err_contour_vp)
+
+        # Method 2 - based on amplitude
+        elif err_method == 'amp':
+
+            self.err_contour_vp = 0.5
+            err = np.where(msf > self.err_contour_vp)
+
+        else:
+            raise(Exception("'err_method' must be either 'stats' or 'amp'"))
+        self.err_method = err_method
+
+        # Estimate uncertainty (q confidence interval)
+        self.err_h0 = max(0.25*(H[max(err[0])] - H[min(err[0])]), self.dh)
+        self.err_k0 = max(0.25*(k[max(err[1])] - k[min(err[1])]), self.dk)
+        self.err_vp0 = max(0.25*(vp[max(err[2])] - vp[min(err[2])]), self.dvp)
+
     def plot(self, save=False, title=None, form='png'):
         """
         Method to plot H-K stacks. By default all 4 panels
@@ -549,6 +1128,61 @@ class HkStack(object):
 
         plt.close()
 
+    def plot_vp(self, save=False, title=None, form='png'):
+        """
+        Method to plot the marginal projections of the joint H-k-Vp
+        stack onto the H-k, H-Vp and k-Vp planes, along with the position
+        of the maximum stack value.
+
+        Parameters
+        ----------
+        save : bool
+            Whether or not to save the Figure
+        title : str
+            Title of plot
+        """
+
+        if not hasattr(self, 'stack3d'):
+            raise(Exception("Joint H-k-Vp stacks have not been averaged yet"))
+
+        # Initialize arrays based on bounds
+        H = np.arange(self.hbound[0], self.hbound[1] + self.dh, self.dh)
+        k = np.arange(self.kbound[0], self.kbound[1] + self.dk, self.dk)
+        vp = np.arange(self.vpbound[0], self.vpbound[1] + self.dvp, self.dvp)
+
+        # Set up figure
+        fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(12, 4))
+
+        cmap = 'RdBu_r'
+
+        for ax, proj, ext, x0, y0, xl, yl in [
+                (ax1, self.proj_hk, (H.min(), H.max(), k.min(), k.max()),
+                 self.h0, self.k0, 'Thickness (km)', 'Vp/Vs'),
+                (ax2, self.proj_hvp, (H.min(), H.max(), vp.min(), vp.max()),
+                 self.h0, self.vp0, 'Thickness (km)', 'Vp (km/s)'),
+                (ax3, self.proj_kvp, (k.min(), k.max(), vp.min(), vp.max()),
+                 self.k0, self.vp0, 'Vp/Vs', 'Vp (km/s)')]:
+            vmax = np.abs(max(proj.max(), proj.min(), key=abs))
+            ax.imshow(np.rot90(proj), cmap=cmap, extent=ext,
+                      vmin=-vmax, vmax=vmax, aspect='auto')
+            ax.scatter(x0, y0, 60, marker='*', color='white')
+            ax.set_xlabel(xl)
+            ax.set_ylabel(yl)
+
+        if title:
+            plt.suptitle(title)
+        else:
+            plt.suptitle('H-k-Vp stacks, station: ' +
+                         self.rfV1[0].stats.station)
+
+        if save:
+            plt.savefig('HK_PLOTS/hkvp.' + self.rfV1[0].stats.station +
+                        '.' + title+'.'+self.typ+'.'+form, format=form)
+        else:
+            plt.show()
+
+        plt.close()
+
 ## JMG ##
     def save(self, file):
         ## JMG ##
@@ -567,7 +1201,7 @@ class HkStack(object):
         pickle.dump(self, output)
         output.close()
 
-    def _residuals(self):
+    def _residuals(self, vp=None):
         """ 
         Internal method to obtain residuals between observed and predicted
         receiver functions given the Moho depth and Vp/Vs obtained from
@@ -575,12 +1209,15 @@ class HkStack(object):
         """
         from telewavesim import utils
 
+        if not vp:
+            vp = self.vp
+
         # Simple 1-layer model over half-space
         model = utils.Model(
             [self.h0, 0.],
             [2800., 3300.],
-            [self.vp, 8.0],
-            [self.vp/self.k0, 4.5],
+            [vp, 8.0],
+            [vp/self.k0, 4.5],
             ['iso', 'iso'])
 
         # Parameters for run
@@ -590,15 +1227,24 @@ class HkStack(object):
 
         trR = Stream()
 
+        # Synthetic receiver functions are memoised, since many traces
+        # share the same slowness bin and repeated calls share the model.
+        # The least recently used ones are discarded beyond the cache size
         for sl in slow:
-            trxyz = utils.run_plane(model, sl, npts, dt)
-            tfs = utils.tf_from_xyz(
-                trxyz, pvh=True, vp=self.vp, vs=self.vp/self.k0)
-            tfs[0].data = np.fft.fftshift(tfs[0].data)
-            trR.append(tfs[0])
-
-        trR.filter('bandpass', freqmin=0.05, freqmax=0.5, corners=2,
-                   zerophase=True)
+            key = tuple(np.round([self.h0, self.k0, vp, sl, dt], 8)) + (npts,)
+            if key in _SYNTH_CACHE:
+                _SYNTH_CACHE.move_to_end(key)
+            else:
+                trxyz = utils.run_plane(model, sl, npts, dt)
+                tfs = utils.tf_from_xyz(
+                    trxyz, pvh=True, vp=vp, vs=vp/self.k0)
+                tfs[0].data = np.fft.fftshift(tfs[0].data)
+                tfs[0].filter('bandpass', freqmin=0.05, freqmax=0.5,
+                              corners=2, zerophase=True)
+                _SYNTH_CACHE[key] = tfs[0]
+                if len(_SYNTH_CACHE) > _SYNTH_CACHE_SIZE:
+                    _SYNTH_CACHE.popitem(last=False)
+            trR.append(_SYNTH_CACHE[key].copy())
 
         # Get stream of residuals
         res = trR.copy()
@@ -616,22 +1262,110 @@ def _dof(st):
 
     """
 
-    dof = []
-    for tr in st:
+    data = np.array([tr.data for tr in st])
+    F = np.abs(np.fft.rfft(data, axis=1))
+
+    E2 = np.sum(F**2, axis=1)
+    E2 -= (F[:, 0]**2 + F[:, -1]**2)/2.
+    E4 = (1./3.)*(F[:, 0]**4 + F[:, -1]**4)
+    E4 += (4./3.)*np.sum(F[:, 1:-1]**4, axis=1)
+
+    dof = (4.*E2**2/E4 - 2.).astype(int)
+
+    return int(dof.min())
+
+
+# Synthetic receiver functions of _residuals, in least recently used order
+_SYNTH_CACHE = OrderedDict()
+_SYNTH_CACHE_SIZE = 256
+
+
+def _positive_lags(stream):
+    """
+    Function to keep only the positive lags of receiver functions
+    whose time axis starts at negative lags
+
+    """
 
-        F = np.abs(np.fft.fft(tr.data)[0:int(len(tr.data)/2)+1])
+    for tr in stream:
+        if tr.stats.taxis[0] < 0.:
+            nn = tr.stats.npts
+            tr.data = np.fft.fftshift(tr.data)[0:int(nn/2)]
+            tr.stats.taxis = np.arange(int(nn/2))*tr.stats.delta
 
-        E2 = np.sum(F**2)
-        E2 -= (F[0]**2 + F[-1]**2)/2.
-        E4 = (1./3.)*(F[0]**4 + F[-1]**4)
-        for i in range(1, len(F) - 1):
-            E4 += (4./3.)*F[i]**4
 
-        dof.append(int(4.*E2**2/E4 - 2.))
+def _trace_key(trace):
+    """
+    Function to identify a receiver function trace in incremental stacks
 
-    dof_max = min(dof)
+    """
 
-    return dof_max
+    return trace.id + '.' + str(trace.stats.starttime)
+
+
+def _combine(pws, weights, typ):
+    """
+    Function to combine phase stacks (phase index along the last axis)
+    into a final stack using a weighted sum or the product of positive
+    weighted values
+
+    """
+
+    pws = pws*np.array(weights)
+
+    if typ == 'sum':
+        stack = np.sum(pws, axis=-1)
+    elif typ == 'product':
+        # Zero out negative values, ignoring phases with zero weight
+        for ip in range(pws.shape[-1]):
+            if weights[ip] == 0.:
+                pws[..., ip] = 1.
+        stack = np.prod(np.clip(pws, 0., None), axis=-1)
+    else:
+        raise(Exception("'typ' must be either 'sum' or 'product'"))
+
+    return stack
+
+
+def _boot_worker(idx):
+    """
+    Function to find the (H, k) indices of the maximum of the final
+    stack for each row of trace indices in ``idx``, given the per-trace
+    moveout samples shared by :func:`~rfpy.utils.pool_imap`
+
+    """
+
+    shared = utils.SHARED
+    ind = np.zeros((len(idx), 2), dtype=int)
+    for i, sel in enumerate(idx):
+        amp = shared['amp'][sel]
+        weight = np.abs(np.mean(shared['phasor'][sel], axis=0))**4
+        stack = _combine(np.median(amp, axis=0)*weight,
+                         shared['weights'], shared['typ'])
+        ind[i] = np.unravel_index(np.argmax(stack), stack.shape)
+
+    return ind
+
+
+def _interp_grid(arr, ihc, ikc):
+    """
+    Function to bilinearly interpolate an array evaluated at the coarse
+    node indices ``ihc`` and ``ikc`` of its first two axes onto every
+    node of these axes
+
+    """
+
+    nH, nk = arr.shape[0], arr.shape[1]
+    tmp = np.zeros((nH, len(ikc)) + arr.shape[2:])
+    out = np.zeros(arr.shape)
+    for j, ik in enumerate(ikc):
+        for ip in range(arr.shape[2]):
+            tmp[:, j, ip] = np.interp(np.arange(nH), ihc, arr[ihc, ik, ip])
+    for ih in range(nH):
+        for ip in range(arr.shape[2]):
+            out[ih, :, ip] = np.interp(np.arange(nk), ikc, tmp[ih, :, ip])
+
+    return out
 
 
 def _dtime_(trace, z, r, vp, ph):
@@ -719,6 +1453,66 @@ def _dtime_dip_(trace, z, r, vp, ph, strike, dip):
     return tt
 
 
+def _dtime_grid(slow, z, r, vp, ph):
+    """
+    Function to calculate travel times for different scattered phases
+    for arrays of slowness, thickness and Vp/Vs values at once. Returns
+    an array of shape ``(len(slow), len(z), len(r))``
+
+    """
+
+    slow = np.asarray(slow)[:, None, None]
+    z = np.asarray(z)[None, :, None]
+    r = np.asarray(r)[None, None, :]
+
+    # Vertical slownesses
+    c1 = np.sqrt((r/vp)**2 - slow**2)
+    c2 = np.sqrt((1./vp)**2 - slow**2)
+
+    if ph == 'ps':
+        tt = z*(c1 - c2)
+    elif ph == 'pps':
+        tt = z*(c1 + c2)
+    elif ph == 'pss':
+        tt = 2.*z*c1
+
+    return tt
+
+
+def _shift_samples(data, dt, tt):
+    """
+    Function to obtain the first sample of the analytic signal of the
+    traces ``data`` (shape ``ntr, npts``) shifted in time by ``tt``
+    (shape ``ntr, ...``) in the Fourier domain, i.e. the value of
+    :func:`~scipy.signal.hilbert` of :func:`~rfpy.hk._timeshift_` at lag
+    zero, without shifting each trace in turn. Returns the real amplitude
+    and instantaneous phase.
+
+    """
+
+    nt = data.shape[1]
+    freq = np.fft.fftfreq(nt, d=dt)
+    ftrace = np.fft.fft(data, axis=1)/nt
+
+    # Positive frequencies are doubled and negative ones discarded, except
+    # for the zero and Nyquist frequencies, where the shifted trace is real.
+    # The sum over positive frequencies is evaluated by Horner's scheme in
+    # powers of the phase shift of the lowest frequency
+    npos = (nt + 1)//2
+    shape = (-1,) + (1,)*(tt.ndim - 1)
+    zshift = np.exp(2.*np.pi*1j*freq[1]*tt)
+    val = np.zeros(tt.shape, dtype=complex)
+    for i in range(npos - 1, 0, -1):
+        val += 2.*ftrace[:, i].reshape(shape)
+        val *= zshift
+    val += ftrace[:, 0].reshape(shape)
+    if nt % 2 == 0:
+        val += np.real(ftrace[:, npos].reshape(shape) *
+                       np.exp(2.*np.pi*1j*freq[npos]*tt))
+
+    return val.real, np.arctan2(val.imag, val.real)
+
+
 def _timeshift_(trace, tt):
     """
     Function to shift traces in time given travel time
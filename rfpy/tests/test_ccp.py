@@ -0,0 +1,424 @@
+import numpy as np
+import pytest
+from obspy.core import Stream, Trace
+from scipy import ndimage
+from scipy.signal import hilbert
+from rfpy import CCPimage
+from rfpy import binning
+from rfpy import ccp
+from rfpy.ccp import haversine
+
+
+def _station_stream(stla, stlo, ntr=20, npts=512, dt=0.1, seed=0):
+    """
+    Radial receiver functions centred on zero lag with a Moho conversion
+    and its multiples, plus random noise
+
+    """
+
+    rng = np.random.default_rng(seed)
+    t = (np.arange(npts) - npts//2)*dt
+    rfR = Stream()
+    for i in range(ntr):
+        data = np.exp(-(t/0.3)**2) + 0.4*np.exp(-((t - 4.2)/0.4)**2) + \
+            0.2*np.exp(-((t - 14.)/0.5)**2) - \
+            0.2*np.exp(-((t - 18.)/0.5)**2) + 0.05*rng.normal(size=npts)
+        tr = Trace(data=data)
+        tr.stats.delta = dt
+        tr.stats.slow = rng.uniform(0.041, 0.079)
+        tr.stats.baz = rng.uniform(0., 360.)
+        tr.stats.stla = stla
+        tr.stats.stlo = stlo
+        tr.stats.network = 'XX'
+        tr.stats.station = 'S{0:02d}'.format(seed)
+        tr.stats.channel = 'RFR'
+        tr.stats.taxis = t.copy()
+        rfR.append(tr)
+
+    return rfR
+
+
+def _ccpimage(nsta=3):
+    ccpimage = CCPimage(coord_start=[45., -75.], coord_end=[45.2, -74.],
+                        dx=5., dz=2.)
+    for i in range(nsta):
+        ccpimage.add_rfstream(_station_stream(
+            45. + 0.2*i/nsta, -75. + 1.*i/nsta, seed=i))
+    ccpimage.prep_data(nslow=11)
+    ccpimage.prestack()
+    return ccpimage
+
+
+def test_slowness_bins():
+    assert np.array_equal(binning.slowness_bins(21),
+                          np.linspace(0.04, 0.08, 21))
+
+
+def test_ccp_loop():
+    ccpimage = _ccpimage()
+    ccpimage.ccp()
+
+    # Assign each raypath sample to its nearest node, one at a time
+    xs_lat = np.linspace(ccpimage.xs_lat1, ccpimage.xs_lat2, ccpimage.nx)
+    xs_lon = np.linspace(ccpimage.xs_lon1, ccpimage.xs_lon2, ccpimage.nx)
+    cells = {}
+    for amps, phases, lon_depth, lat_depth in ccpimage._prep_samples():
+        for iz in range(ccpimage.nz):
+            for j in range(lat_depth.shape[1]):
+                ix = np.argmin(haversine(
+                    lat_depth[iz, j], lon_depth[iz, j], xs_lat, xs_lon))
+                cells.setdefault((iz, ix), []).append(
+                    (amps[0][iz, j], phases[0][iz, j]))
+
+    avg = np.zeros((ccpimage.nz, ccpimage.nx))
+    stderr = np.zeros((ccpimage.nz, ccpimage.nx))
+    coh = np.zeros((ccpimage.nz, ccpimage.nx))
+    for (iz, ix), samples in cells.items():
+        amp, phase = np.array(samples).T
+        avg[iz, ix] = np.mean(amp)
+        if len(amp) > 1:
+            stderr[iz, ix] = np.std(amp, ddof=1)/np.sqrt(len(amp))
+        coh[iz, ix] = np.abs(np.mean(np.exp(1j*phase)))
+
+    assert np.allclose(ccpimage.xs_ps_avg, avg, atol=1.e-10)
+    assert np.allclose(ccpimage.xs_ps_stderr, stderr, atol=1.e-8)
+    assert np.allclose(ccpimage.xs_ps_coh, coh, atol=1.e-10)
+
+
+def test_stacks_loop():
+    ccpimage = _ccpimage()
+    ccpimage.gccp()
+    xs = [ccpimage.xs_gauss_ps*ccpimage.weights[0],
+          ccpimage.xs_gauss_pps*ccpimage.weights[1],
+          ccpimage.xs_gauss_pss*ccpimage.weights[2]]
+
+    # Stack each column in turn
+    lin = np.zeros((ccpimage.nz, ccpimage.nx))
+    pws = np.zeros((ccpimage.nz, ccpimage.nx))
+    for ix in range(ccpimage.nx):
+        weight = np.zeros(ccpimage.nz, dtype=complex)
+        for trace in xs:
+            thilb = hilbert(trace[:, ix])
+            weight += np.exp(1j*np.arctan2(thilb.imag, thilb.real))
+        weight = np.abs(weight)/3.
+        lin[:, ix] = xs[0][:, ix] + xs[1][:, ix] + xs[2][:, ix]
+        pws[:, ix] = lin[:, ix]*weight**2
+
+    ccpimage.linear_stack(typ='gccp')
+    assert np.allclose(ccpimage.tot_trace, lin, atol=1.e-12)
+    ccpimage.phase_weighted_stack(typ='gccp')
+    assert np.allclose(ccpimage.tot_trace, pws, atol=1.e-12)
+
+    # Chunks of columns give the same stacks
+    ccpimage.phase_weighted_stack(typ='gccp', chunk_size=3)
+    assert np.allclose(ccpimage.tot_trace, pws, atol=1.e-12)
+
+
+def test_reproject_clears_stats():
+    ccpimage = _ccpimage()
+    ccpimage.ccp()
+    profile = [[45., -75.], [45.1, -74.5]]
+    other = ccpimage.prestack(profiles=[profile])[0]
+    assert other.nx != ccpimage.nx
+    for phase in ['ps', 'pps', 'pss']:
+        for stat in ['avg', 'stderr', 'coh']:
+            assert not hasattr(other, 'xs_'+phase+'_'+stat)
+    other.ccp()
+    assert other.xs_ps_coh.shape == (other.nz, other.nx)
+    assert ccpimage.xs_ps_coh.shape == (ccpimage.nz, ccpimage.nx)
+
+
+def test_kernels_cache(tmp_path, monkeypatch):
+    dep = np.arange(0., 60., 2.)
+    vp = np.linspace(5.8, 8., len(dep))
+    vs = vp/1.73
+    slow = binning.slowness_bins(11)
+    monkeypatch.setattr(ccp, '_KERNELS', {})
+
+    # Only slowness values missing from the cache are computed
+    nslow = []
+    ray_table = ccp.ray_table
+
+    def counted(slow, *args):
+        nslow.append(len(slow))
+        return ray_table(slow, *args)
+
+    monkeypatch.setattr(ccp, 'ray_table', counted)
+    kernels = ccp.ray_kernels(slow[:6], dep, vp, vs)
+    assert nslow == [6]
+    ccp.ray_kernels(slow[:6], dep, vp, vs)
+    assert nslow == [6]
+    table = ccp.ray_kernels(slow, dep, vp, vs)
+    assert nslow == [6, 5]
+    for tab, ref in zip(table, ray_table(slow, dep, vp, vs)):
+        assert np.allclose(tab, ref, rtol=1.e-8)
+    for tab, ref in zip(kernels, table):
+        assert np.array_equal(tab, ref[:6])
+
+    # A second station with the same model reuses the kernels
+    ccpimage = CCPimage(coord_start=[45., -75.], coord_end=[45.2, -74.],
+                        dx=5., dz=2.)
+    for i in range(2):
+        ccpimage.add_rfstream(_station_stream(45., -75. + 0.5*i, seed=i))
+    ncall = len(nslow)
+    ccpimage._ray_tables(11)
+    assert len(nslow) == ncall + 1
+    ccpimage._ray_tables(11)
+    assert len(nslow) == ncall + 1
+
+    # Round trip through the kernel file
+    file = str(tmp_path / 'kernels.pkl')
+    ccp.save_kernels(file)
+    saved = dict(ccp._KERNELS)
+    monkeypatch.setattr(ccp, '_KERNELS', {})
+    ccp.load_kernels(file)
+    assert ccp._KERNELS.keys() == saved.keys()
+    for tab, ref in zip(ccp.ray_kernels(slow, dep, vp, vs), table):
+        assert np.array_equal(tab, ref)
+    assert len(nslow) == ncall + 1
+
+
+def test_extract_profile():
+    ccpimage = _ccpimage(nsta=4)
+    ccpimage.ccp()
+    avg = ccpimage.xs_ps_avg.copy()
+    count = ccpimage.xs_count.copy()
+    hit = count > 0
+    profile = [[ccpimage.xs_lat1, ccpimage.xs_lon1],
+               [ccpimage.xs_lat2, ccpimage.xs_lon2]]
+
+    # Default cells
+    ccpimage.prestack_volume()
+    ccpimage.extract_profile(*profile)
+    ccpimage.ccp()
+    assert ccpimage.xs_count.sum() == count.sum()
+    assert np.corrcoef(ccpimage.xs_ps_avg[hit], avg[hit])[0, 1] > 0.95
+
+    # Fine cells converge to the direct projection
+    dlat = 0.01*ccpimage.dx/111.
+    ccpimage.prestack_volume(dlat=dlat, dlon=dlat/np.cos(np.radians(45.1)))
+    ccpimage.extract_profile(*profile)
+    ccpimage.ccp()
+    assert np.abs(ccpimage.xs_count - count).sum() < 0.01*count.sum()
+    assert np.corrcoef(ccpimage.xs_ps_avg[hit], avg[hit])[0, 1] > 0.999
+
+
+def test_depth_slice():
+    ccpimage = _ccpimage()
+    ccpimage.prestack_volume()
+    z = 30.
+    lat, lon, amp = ccpimage.depth_slice(z, phase='ps')
+
+    # Average the samples of each cell of the slice one at a time
+    iz = int(np.rint(z/ccpimage.dz))
+    dlat = lat[1] - lat[0]
+    dlon = lon[1] - lon[0]
+    total = np.zeros(amp.shape)
+    count = np.zeros(amp.shape)
+    for amps, phases, lon_depth, lat_depth in ccpimage._prep_samples():
+        for j in range(lat_depth.shape[1]):
+            ilat = int(np.rint((lat_depth[iz, j] - lat[0])/dlat))
+            ilon = int(np.rint((lon_depth[iz, j] - lon[0])/dlon))
+            total[ilat, ilon] += amps[0][iz, j]
+            count[ilat, ilon] += 1
+    ref = np.zeros(amp.shape)
+    ref[count > 0] = total[count > 0]/count[count > 0]
+    assert count.sum() > 0
+    assert np.allclose(amp, ref, atol=1.e-12)
+
+
+def test_amplitudes_timeshift():
+    st = _station_stream(45., -75., ntr=4, npts=256)
+    dt = st[0].stats.delta
+    nt = st[0].stats.npts
+    rng = np.random.default_rng(0)
+
+    # Travel times between samples, including negative times that wrap
+    # around to the end of the traces
+    tt = rng.uniform(-5., (nt - 1)*dt, size=(len(st), 30))
+    tt[:, 0] = -0.02
+    tt[:, 1] = (nt - 1)*dt
+    amp, phase = ccp.amplitudes(st, tt)
+    for i, tr in enumerate(st):
+        for j in range(tt.shape[1]):
+            ref_amp, ref_phase = ccp.timeshift(tr, tt[i, j])
+            assert np.isclose(amp[i, j], ref_amp, atol=1.e-12)
+            assert np.isclose(phase[i, j], ref_phase, atol=1.e-12)
+    assert (tt < 0.).any()
+
+
+def test_raypaths_loop():
+    st = _station_stream(45., -75., ntr=5)
+    dep = np.arange(0., 80., 2.)
+    vp = np.linspace(5.8, 8.1, len(dep))
+    vs = vp/1.75
+    delta_z = dep[1] - dep[0]
+    ttps, ttpps, ttpss, plon, plat = ccp.raypaths(
+        [tr.stats.slow for tr in st], [tr.stats.baz for tr in st],
+        45., -75., dep=dep, vp=vp, vs=vs)
+
+    # Sum the layers above each depth one at a time
+    for itr, tr in enumerate(st):
+        for iz in range(len(dep)):
+            dtps = dtpps = dtpss = delta_x = 0.
+            for i in range(iz):
+                dtps += ccp.ttime(tr, delta_z, vp[i], vs[i], 'Ps')
+                dtpps += ccp.ttime(tr, delta_z, vp[i], vs[i], 'Pps')
+                dtpss += ccp.ttime(tr, delta_z, vp[i], vs[i], 'Pss')
+                delta_x += ccp.ppoint_distance(tr, delta_z, vs[i])
+            plo, pla = ccp.ppoint(tr, delta_x)
+            assert np.isclose(ttps[itr, iz], dtps, atol=1.e-12)
+            assert np.isclose(ttpps[itr, iz], dtpps, atol=1.e-12)
+            assert np.isclose(ttpss[itr, iz], dtpss, atol=1.e-12)
+            assert np.isclose(plon[itr, iz], plo, atol=1.e-12)
+            assert np.isclose(plat[itr, iz], pla, atol=1.e-12)
+
+    # Interpolation in a table of slowness values
+    table_slow = binning.slowness_bins(41)
+    table = ccp.ray_table(table_slow, dep, vp, vs)
+    interp = ccp.raypaths_table(
+        table_slow, table, [tr.stats.slow for tr in st],
+        [tr.stats.baz for tr in st], 45., -75.)
+    for arr, ref in zip(interp, [ttps, ttpps, ttpss, plon, plat]):
+        assert np.allclose(arr, ref, atol=1.e-4)
+
+
+def test_prep_data_nproc():
+    images = []
+    for nproc in [1, 2]:
+        ccpimage = CCPimage(coord_start=[45., -75.], coord_end=[45.2, -74.],
+                            dx=5., dz=2.)
+        for i in range(3):
+            ccpimage.add_rfstream(_station_stream(45., -75. + 0.3*i, seed=i))
+        ccpimage.prep_data(nslow=11, nproc=nproc)
+        images.append(ccpimage)
+
+    serial, pooled = images
+    assert serial.n_traces == pooled.n_traces
+    for attr in ['amp_ps_depth', 'amp_pps_depth', 'amp_pss_depth',
+                 'lon_depth', 'lat_depth', 'phase_ps_depth',
+                 'phase_pps_depth', 'phase_pss_depth']:
+        assert np.array_equal(getattr(serial, attr), getattr(pooled, attr))
+
+
+def test_prestack_profiles():
+    ccpimage = _ccpimage()
+    prep = [ccpimage.amp_ps_depth.copy(), ccpimage.lat_depth.copy()]
+    profile = [[ccpimage.xs_lat1, ccpimage.xs_lon1],
+               [ccpimage.xs_lat2, ccpimage.xs_lon2]]
+    other = ccpimage.prestack(profiles=[profile])[0]
+    assert other is not ccpimage
+
+    # Projecting onto the original profile gives the same grids
+    assert other.nx == ccpimage.nx
+    assert np.array_equal(other.xs_count, ccpimage.xs_count)
+    for phase in ['ps', 'pps', 'pss']:
+        for acc in ['xs_sum_', 'xs_sumsq_', 'xs_phsum_']:
+            assert np.allclose(getattr(other, acc+phase),
+                               getattr(ccpimage, acc+phase), atol=1.e-12)
+
+    # The output of prep_data of the source object is kept
+    assert ccpimage.is_ready_for_prestack
+    assert np.array_equal(ccpimage.amp_ps_depth, prep[0])
+    assert np.array_equal(ccpimage.lat_depth, prep[1])
+    ccpimage.prestack()
+    assert np.array_equal(ccpimage.xs_count, other.xs_count)
+
+
+def test_prep_chunks(tmp_path):
+    memory = _ccpimage(nsta=4)
+    memory.ccp()
+
+    # Stale chunks of a previous store are replaced
+    path = tmp_path / 'CCP_PREP'
+    path.mkdir()
+    for i in range(4):
+        np.savez(path / 'prep_{0:04d}.npz'.format(i), stale=np.zeros(1))
+
+    chunked = CCPimage(coord_start=[45., -75.], coord_end=[45.2, -74.],
+                       dx=5., dz=2.)
+    for batch in [[0, 1], [2, 3]]:
+        for i in batch:
+            chunked.add_rfstream(_station_stream(
+                45. + 0.2*i/4, -75. + 1.*i/4, seed=i))
+        chunked.prep_data(nslow=11, path=path)
+    assert len(chunked.prep_chunks) == 2
+    assert sorted(p.name for p in path.iterdir()) == \
+        ['prep_0000.npz', 'prep_0001.npz']
+    assert chunked.n_traces == memory.n_traces
+
+    chunked.prestack()
+    chunked.ccp()
+    assert np.array_equal(chunked.xs_count, memory.xs_count)
+    for phase in ['ps', 'pps', 'pss']:
+        for stat in ['avg', 'stderr', 'coh']:
+            attr = 'xs_'+phase+'_'+stat
+            assert np.allclose(getattr(chunked, attr), getattr(memory, attr),
+                               atol=1.e-10)
+
+
+def test_add_velocity_model():
+    dep = np.array([0., 4., 8., 14., 30., 35., 45., 110.])
+    vp = np.array([4.0, 5.9, 6.2, 6.3, 6.8, 7.2, 8.0, 8.1])
+    background = _ccpimage()
+    ccpimage = CCPimage(coord_start=[45., -75.], coord_end=[45.2, -74.],
+                        dx=5., dz=2.)
+
+    # Models that do not reach the bottom of the image are rejected
+    with pytest.raises(Exception):
+        ccpimage.add_velocity_model(45., -75., dep[:-1], vp[:-1])
+    assert len(ccpimage.vmodels) == 0
+
+    # A single column equal to the background model gives the 1D result
+    ccpimage.add_velocity_model(45.1, -74.5, dep, vp)
+    assert np.array_equal(ccpimage.vmodels[0]['vp'], ccpimage.vp)
+    assert np.array_equal(ccpimage.vmodels[0]['vs'], ccpimage.vs)
+    for i in range(3):
+        ccpimage.add_rfstream(_station_stream(
+            45. + 0.2*i/3, -75. + 1.*i/3, seed=i))
+    ccpimage.prep_data(nslow=11)
+    for attr in ['amp_ps_depth', 'amp_pps_depth', 'amp_pss_depth',
+                 'lon_depth', 'lat_depth', 'phase_ps_depth',
+                 'phase_pps_depth', 'phase_pss_depth']:
+        assert np.array_equal(getattr(ccpimage, attr),
+                              getattr(background, attr))
+
+
+def test_gaussian_smooth():
+    arr = np.random.default_rng(0).normal(size=(60, 80))
+
+    # Constant widths are the same as a 2D Gaussian filter
+    assert np.allclose(ccp._gaussian_smooth(arr, 3., 2.),
+                       ndimage.gaussian_filter(arr, (2., 3.)), atol=1.e-12)
+    assert np.allclose(ccp._gaussian_smooth(arr, np.full(60, 3.)),
+                       ndimage.gaussian_filter(arr, (0., 3.)), atol=1.e-12)
+
+    # Depth-varying widths, compared with smoothing each row in turn
+    for sigma in [np.linspace(0.3, 1.5, 60), np.linspace(1., 6., 60),
+                  np.linspace(3., 20., 60)]:
+        ref = np.array([ndimage.gaussian_filter1d(row, sig)
+                        for row, sig in zip(arr, sigma)])
+        assert np.allclose(ccp._gaussian_smooth(arr, sigma), ref, atol=1.e-4)
+
+
+def test_migrate_negative_lags():
+    dep = np.arange(0., 60., 1.)
+    vp = np.linspace(5.8, 8., len(dep))
+    vs = vp/1.73
+    for npts in [256, 255]:
+        causal = _station_stream(45., -75., ntr=4, npts=npts)
+        centred = causal.copy()
+        for tr in causal:
+            tr.data = np.roll(tr.data, -(npts//2))
+            tr.stats.taxis = np.arange(npts)*tr.stats.delta
+
+        # Zero lag at the centre of the traces gives the same amplitudes
+        # as zero lag at the first sample
+        for phase in ['ps', 'pps', 'pss']:
+            amp = ccp.migrate(centred, dep, vp, vs, phase=phase)
+            ref = ccp.migrate(causal, dep, vp, vs, phase=phase)
+            assert np.allclose(amp, ref, atol=1.e-10)
+
+        # Depth zero is the direct P arrival at zero lag
+        assert np.allclose(amp[:, 0], [tr.data[0] for tr in causal],
+                           atol=1.e-10)
@@ -0,0 +1,327 @@
+import numpy as np
+from obspy.core import Stream, Trace
+from rfpy import Harmonics
+from rfpy.ccp import migrate
+from rfpy.harmonics import dcomp_batch
+
+
+def _synthetic_streams(nbin=32, npts=256, dt=0.1, seed=0):
+    """
+    Radial and transverse receiver functions with a constant, a first
+    and a second order back-azimuth harmonic, plus random noise
+
+    """
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(npts)*dt
+    rfR = Stream()
+    rfT = Stream()
+    for baz in np.sort(rng.uniform(0., 360., nbin)):
+        b = np.radians(baz)
+        g1 = np.exp(-((t - 5.)/0.4)**2)
+        g2 = np.exp(-((t - 8.)/0.4)**2)
+        radial = np.exp(-((t - 3.)/0.3)**2) + 0.3*np.cos(b - 0.5)*g1 + \
+            0.2*np.sin(2.*b)*g2 + 0.02*rng.normal(size=npts)
+        transv = 0.3*np.sin(b - 0.5)*g1 + 0.2*np.cos(2.*b)*g2 + \
+            0.02*rng.normal(size=npts)
+        for st, data in zip([rfR, rfT], [radial, transv]):
+            tr = Trace(data=data)
+            tr.stats.delta = dt
+            tr.stats.baz = baz
+            tr.stats.slow = 0.06
+            tr.stats.taxis = t.copy()
+            st.append(tr)
+
+    return rfR, rfT
+
+
+def test_find_azim_range():
+    for seed in range(4):
+        rfR, rfT = _synthetic_streams(seed=seed)
+        harmonics = Harmonics(rfR, rfT, xmin=2., xmax=12.)
+        harmonics.dcomp_find_azim(daz=0.1)
+        assert 0. <= harmonics.azim < 180.
+
+
+def _stations():
+    """
+    Synthetic stations with different numbers of receiver functions
+    and of samples
+
+    """
+
+    return [_synthetic_streams(nbin=nbin, npts=npts, seed=seed)
+            for nbin, npts, seed in [(32, 256, 0), (20, 200, 1),
+                                     (40, 256, 2)]]
+
+
+def _harmonics_data(harmonics):
+    return np.array([tr.data for tr in harmonics.hstream])
+
+
+def test_batch_fix_azim():
+    stations = _stations()
+    single = [Harmonics(rfR, rfT, azim=30.) for rfR, rfT in stations]
+    batch = [Harmonics(rfR.copy(), rfT.copy(), azim=30.)
+             for rfR, rfT in stations]
+
+    for h in single:
+        h.dcomp_fix_azim()
+    dcomp_batch(batch)
+
+    for h1, h2 in zip(single, batch):
+        assert h1.azim == h2.azim
+        assert np.allclose(_harmonics_data(h1), _harmonics_data(h2),
+                           atol=1.e-8)
+
+
+def test_batch_find_azim():
+    stations = _stations()
+    single = [Harmonics(rfR, rfT, xmin=2., xmax=12.)
+              for rfR, rfT in stations]
+    batch = [Harmonics(rfR.copy(), rfT.copy(), xmin=2., xmax=12.)
+             for rfR, rfT in stations]
+
+    for h in single:
+        h.dcomp_find_azim(daz=0.5)
+    dcomp_batch(batch, find_azim=True, daz=0.5)
+
+    for h1, h2 in zip(single, batch):
+        assert abs(h1.azim - h2.azim) < 1.e-6
+        assert np.allclose(_harmonics_data(h1), _harmonics_data(h2),
+                           atol=1.e-8)
+        assert np.allclose(h1.var, h2.var, atol=1.e-8)
+
+
+def _baseline_harmonics(rfR, rfT, azim):
+    """
+    Harmonics along ``azim`` obtained by truncated SVD of the system of
+    equations at each depth step in turn
+
+    """
+
+    deg2rad = np.pi/180.
+    nbin = len(rfR)
+    nz = len(rfR[0].data)
+    CC = np.zeros((5, nz))
+    for iz in range(nz):
+        OBS = np.zeros(2*nbin)
+        H = np.zeros((2*nbin, 5))
+        for irow, trace in enumerate(rfR):
+            baz = trace.stats.baz
+            OBS[irow] = trace.data[iz]
+            H[irow] = [1., np.cos(deg2rad*(baz - azim)),
+                       np.sin(deg2rad*(baz - azim)),
+                       np.cos(2.*deg2rad*(baz - azim)),
+                       np.sin(2.*deg2rad*(baz - azim))]
+        for irow, trace in enumerate(rfT):
+            baz = trace.stats.baz
+            OBS[irow + nbin] = trace.data[iz]
+            H[irow + nbin] = [0., np.cos(deg2rad*(baz + 90. - azim)),
+                              np.sin(deg2rad*(baz + 90. - azim)),
+                              np.cos(2.*deg2rad*(baz + 45. - azim)),
+                              np.sin(2.*deg2rad*(baz + 45. - azim))]
+        u, s, v = np.linalg.svd(H)
+        s[s < 0.001] = 0.
+        CC[:, iz] = np.linalg.solve(s[:, None]*v, u.T.dot(OBS)[:5])
+
+    return CC
+
+
+def test_fix_azim_baseline():
+    rfR, rfT = _synthetic_streams()
+    harmonics = Harmonics(rfR, rfT, azim=30.)
+    harmonics.dcomp_fix_azim()
+    CC = _baseline_harmonics(rfR, rfT, 30.)
+    assert np.allclose(_harmonics_data(harmonics), CC, atol=1.e-10)
+
+
+def test_find_azim_baseline():
+    rfR, rfT = _synthetic_streams()
+    harmonics = Harmonics(rfR, rfT, xmin=2., xmax=12.)
+    harmonics.dcomp_find_azim(daz=10.)
+
+    # Solve along each candidate azimuth
+    dt = rfR[0].stats.delta
+    imin, imax = int(2./dt), int(12./dt)
+    azims = np.arange(0., 180., 10.)
+    B1var = [np.sqrt(np.mean(np.square(
+        _baseline_harmonics(rfR, rfT, azim)[1, imin:imax])))
+        for azim in azims]
+    azim = azims[np.argmin(B1var)]
+    assert harmonics.azim == azim
+    assert np.allclose(_harmonics_data(harmonics),
+                       _baseline_harmonics(rfR, rfT, azim), atol=1.e-10)
+
+
+def test_bootstrap_resample():
+    rfR, rfT = _synthetic_streams(nbin=20)
+    harmonics = Harmonics(rfR, rfT, azim=30.)
+    harmonics.dcomp_fix_azim()
+    harmonics.bootstrap(nboot=10, seed=1)
+
+    # First resample, decomposed explicitly
+    sel = np.random.default_rng(1).integers(0, len(rfR), size=(10, 20))[0]
+    resample = Harmonics(Stream(traces=[rfR[i] for i in sel]),
+                         Stream(traces=[rfT[i] for i in sel]), azim=30.)
+    resample.dcomp_fix_azim()
+    assert np.allclose(harmonics.boot_harmonics[0],
+                       _harmonics_data(resample), atol=1.e-10)
+
+
+def test_bootstrap_nproc():
+    rfR, rfT = _synthetic_streams(nbin=20)
+    harmonics = Harmonics(rfR, rfT, azim=30.)
+    harmonics.dcomp_fix_azim()
+    CC = _harmonics_data(harmonics)
+
+    for method in ['bootstrap', 'jackknife']:
+        harmonics.bootstrap(nboot=50, method=method, seed=0)
+        boot = harmonics.boot_harmonics
+        ci = harmonics.ci_harmonics
+        harmonics.bootstrap(nboot=50, method=method, seed=0, nproc=2)
+        assert np.allclose(harmonics.boot_harmonics, boot, atol=1.e-12)
+        assert np.allclose(harmonics.ci_harmonics, ci, atol=1.e-12)
+
+        # The intervals contain the point estimates, except for a few
+        # samples at the confidence level
+        inside = (ci[0] <= CC) & (CC <= ci[1])
+        assert inside.mean() > 0.9
+
+
+def test_forward_fitted():
+    rfR, rfT = _synthetic_streams()
+    baz = np.array([tr.stats.baz for tr in rfR])
+    harmonics = Harmonics(rfR, rfT, azim=30.)
+    harmonics.dcomp_fix_azim()
+    harmonics.forward()
+    assert np.array_equal([tr.stats.baz for tr in harmonics.radial_forward],
+                          baz)
+
+    # Radial and transverse receiver functions of the harmonics, with the
+    # same signs as in the decomposition
+    CC = _harmonics_data(harmonics)
+    b = np.radians(baz - 30.)[:, None]
+    radial = CC[0] + CC[1]*np.cos(b) + CC[2]*np.sin(b) + \
+        CC[3]*np.cos(2.*b) + CC[4]*np.sin(2.*b)
+    transv = -CC[1]*np.sin(b) + CC[2]*np.cos(b) - \
+        CC[3]*np.sin(2.*b) + CC[4]*np.cos(2.*b)
+    fitR = np.array([tr.data for tr in harmonics.radial_forward])
+    fitT = np.array([tr.data for tr in harmonics.transv_forward])
+    assert np.allclose(fitR, radial, atol=1.e-12)
+    assert np.allclose(fitT, transv, atol=1.e-12)
+
+    # The residuals of the least-squares fit are orthogonal to the
+    # columns of the design matrix
+    resR = np.array([tr.data for tr in rfR]) - fitR
+    resT = np.array([tr.data for tr in rfT]) - fitT
+    ones = np.ones(b.shape)
+    for hR, hT in [(ones, 0.*b), (np.cos(b), -np.sin(b)),
+                   (np.sin(b), np.cos(b)), (np.cos(2.*b), -np.sin(2.*b)),
+                   (np.sin(2.*b), np.cos(2.*b))]:
+        assert np.abs((hR*resR + hT*resT).sum(axis=0)).max() < 1.e-10
+
+    # Noise-free receiver functions of the harmonics are reproduced
+    noisefree = Harmonics(Stream(traces=harmonics.radial_forward),
+                          Stream(traces=harmonics.transv_forward), azim=30.)
+    noisefree.dcomp_fix_azim()
+    noisefree.forward(baz)
+    assert np.allclose(_harmonics_data(noisefree), CC, atol=1.e-10)
+    assert np.allclose([tr.data for tr in noisefree.transv_forward], fitT,
+                       atol=1.e-10)
+
+
+def test_matrix_input():
+    rfR, rfT = _synthetic_streams()
+    baz = [tr.stats.baz for tr in rfR]
+    dt = rfR[0].stats.delta
+    dataR = np.array([tr.data for tr in rfR])
+    dataT = np.array([tr.data for tr in rfT])
+
+    stream = Harmonics(rfR, rfT, xmin=2., xmax=12.)
+    stream.dcomp_find_azim(daz=1.)
+    matrix = Harmonics(dataR, dataT, xmin=2., xmax=12., baz=baz, dx=dt)
+    matrix.dcomp_find_azim(daz=1.)
+    assert matrix.azim == stream.azim
+    assert np.allclose(_harmonics_data(matrix), _harmonics_data(stream),
+                       atol=1.e-12)
+    assert matrix.hstream[0].stats.delta == dt
+
+    stream.dcomp_fix_azim(azim=30., robust=True)
+    matrix.dcomp_fix_azim(azim=30., robust=True)
+    assert np.allclose(_harmonics_data(matrix), _harmonics_data(stream),
+                       atol=1.e-12)
+    assert np.allclose(matrix.weights, stream.weights, atol=1.e-12)
+
+
+def test_migrated_input():
+    rfR, rfT = _synthetic_streams(nbin=20, npts=256)
+    for st in [rfR, rfT]:
+        for tr in st:
+            tr.stats.taxis = (np.arange(256) - 128)*tr.stats.delta
+            tr.data = np.roll(tr.data, 128)
+    dep = np.arange(0., 40., 0.5)
+    vp = np.full(len(dep), 6.3)
+    vs = vp/1.75
+    ampR = migrate(rfR, dep, vp, vs)
+    ampT = migrate(rfT, dep, vp, vs)
+    harmonics = Harmonics(ampR, ampT, baz=[tr.stats.baz for tr in rfR],
+                          dx=0.5, azim=30.)
+    harmonics.dcomp_fix_azim()
+    assert len(harmonics.hstream[0].data) == len(dep)
+
+    # Same as the harmonics in time (of the fftshifted traces), migrated
+    # to depth
+    time = Harmonics(rfR.copy(), rfT.copy(), azim=30.)
+    time.dcomp_fix_azim()
+    causal = Stream(traces=[Trace(data=tr.data, header={
+        'delta': tr.stats.delta, 'slow': 0.06}) for tr in time.hstream])
+    assert np.allclose(_harmonics_data(harmonics),
+                       migrate(causal, dep, vp, vs), atol=1.e-10)
+
+
+def test_robust_outliers():
+    rfR, rfT = _synthetic_streams()
+    outliers = [3, 11, 20]
+    clean = [i for i in range(len(rfR)) if i not in outliers]
+    ref = Harmonics(Stream(traces=[rfR[i].copy() for i in clean]),
+                    Stream(traces=[rfT[i].copy() for i in clean]), azim=30.)
+    ref.dcomp_fix_azim()
+
+    # Noisy receiver functions are down-weighted to about 1%
+    rng = np.random.default_rng(5)
+    for i in outliers:
+        rfR[i].data = rfR[i].data + 2.*rng.normal(size=len(rfR[i].data))
+        rfT[i].data = rfT[i].data + 2.*rng.normal(size=len(rfT[i].data))
+    harmonics = Harmonics(rfR, rfT, azim=30.)
+    harmonics.dcomp_fix_azim(robust=True)
+    assert np.all(harmonics.weights[outliers] < 0.02)
+    assert np.all(harmonics.weights[clean] == 1.)
+
+    # The robust fit recovers the harmonics of the clean receiver
+    # functions, unlike least squares
+    diff = np.abs(_harmonics_data(harmonics) - _harmonics_data(ref)).max()
+    assert diff < 0.01
+    harmonics.dcomp_fix_azim()
+    assert np.abs(_harmonics_data(harmonics) -
+                  _harmonics_data(ref)).max() > 10.*diff
+
+
+def test_find_azim_zero_xmin():
+    stations = _stations()
+    single = [Harmonics(rfR, rfT, xmin=2., xmax=12.)
+              for rfR, rfT in stations]
+    batch = [Harmonics(rfR.copy(), rfT.copy(), xmin=2., xmax=12.)
+             for rfR, rfT in stations]
+    ref = [Harmonics(rfR.copy(), rfT.copy(), xmin=0., xmax=12.)
+           for rfR, rfT in stations]
+
+    # An explicit xmin of zero overrides the range of the objects
+    for h1, h2 in zip(single, ref):
+        h1.dcomp_find_azim(xmin=0., daz=0.5)
+        h2.dcomp_find_azim(daz=0.5)
+    dcomp_batch(batch, find_azim=True, xmin=0., daz=0.5)
+    for h1, h2, h3 in zip(single, batch, ref):
+        assert h1.azim == h3.azim
+        assert abs(h2.azim - h3.azim) < 1.e-6
+        assert np.allclose(h2.var, h3.var, atol=1.e-8)
@@ -0,0 +1,142 @@
+import numpy as np
+from obspy import UTCDateTime
+from obspy.core import Stream, Trace
+from rfpy import HkStack
+from rfpy import utils
+from rfpy.hk import _boot_worker
+
+
+def _synthetic_stream(ntr=16, H=35., k=1.75, vp=6.3, npts=600, dt=0.1,
+                      seed=0):
+    """
+    Radial receiver functions with the Ps, Pps and Pss phases of a
+    single layer over a half-space, plus random noise
+
+    """
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(npts)*dt
+    rfV = Stream()
+    for i, slow in enumerate(np.linspace(0.045, 0.075, ntr)):
+        c1 = np.sqrt((k/vp)**2 - slow**2)
+        c2 = np.sqrt((1./vp)**2 - slow**2)
+        data = np.exp(-(t/0.4)**2) + 0.05*rng.normal(size=npts)
+        for tt, amp in [(H*(c1 - c2), 1.), (H*(c1 + c2), 0.5),
+                        (2.*H*c1, -0.4)]:
+            data += amp*np.exp(-((t - tt)/0.4)**2)
+        tr = Trace(data=data)
+        tr.stats.delta = dt
+        tr.stats.slow = slow
+        tr.stats.baz = 0.
+        tr.stats.taxis = t.copy()
+        tr.stats.station = 'SYN'
+        tr.stats.starttime = UTCDateTime(2020, 1, 1) + i*86400.
+        rfV.append(tr)
+
+    return rfV
+
+
+def _hkstack(rfV, vp=6.3):
+    hkstack = HkStack(rfV, vp=vp)
+    hkstack.hbound = [30., 40.]
+    hkstack.dh = 1.
+    hkstack.kbound = [1.6, 1.9]
+    hkstack.dk = 0.05
+    return hkstack
+
+
+def test_incremental_add_remove():
+    rfV = _synthetic_stream()
+
+    full = _hkstack(rfV.copy())
+    full.stack_incremental()
+
+    hkstack = _hkstack(rfV[:10].copy())
+    hkstack.stack_incremental()
+    hkstack.add_traces(rfV[10:].copy())
+    assert len(hkstack.keys) == len(rfV)
+    assert np.allclose(hkstack.pws, full.pws, atol=1.e-5)
+
+    hkstack.remove_traces(hkstack.keys[10:])
+    ref = _hkstack(rfV[:10].copy())
+    ref.stack_incremental()
+    assert np.allclose(hkstack.pws, ref.pws, atol=1.e-5)
+
+
+def test_incremental_vp_change():
+    rfV = _synthetic_stream()
+
+    hkstack = _hkstack(rfV[:10].copy())
+    hkstack.stack_incremental()
+    hkstack.vp = 6.5
+    hkstack.add_traces(rfV[10:].copy())
+
+    ref = _hkstack(rfV.copy(), vp=6.5)
+    ref.stack_incremental()
+    assert hkstack._incr['grid'][4] == 6.5
+    assert np.allclose(hkstack.pws, ref.pws, atol=1.e-5)
+
+
+def test_stack_vp_matches_stack():
+    rfV = _synthetic_stream(ntr=8, npts=301)
+    hkstack = _hkstack(rfV, vp=6.3)
+    hkstack.stack()
+    hkstack.vpbound = [6.3, 6.3]
+    hkstack.stack_vp()
+    assert np.allclose(hkstack.pws_vp[:, :, 0], hkstack.pws, atol=1.e-10)
+    assert np.allclose(hkstack.sig_vp[:, :, 0], hkstack.sig, atol=1.e-10)
+
+
+def test_bootstrap_matches_stack():
+    rfV = _synthetic_stream(ntr=8, npts=301)
+    hkstack = _hkstack(rfV, vp=6.3)
+    hkstack.stack()
+    hkstack.average(typ='sum')
+
+    # Resampling all traces once reproduces the estimates of the stacks
+    H = np.arange(hkstack.hbound[0], hkstack.hbound[1] + hkstack.dh,
+                  hkstack.dh)
+    k = np.arange(hkstack.kbound[0], hkstack.kbound[1] + hkstack.dk,
+                  hkstack.dk)
+    amp, phasor = hkstack._moveout_samples(H, k, 6.3)
+    utils.share({'amp': amp, 'phasor': phasor,
+                  'weights': hkstack.weights, 'typ': 'sum'})
+    ind = _boot_worker(np.arange(len(rfV))[None, :])[0]
+    assert H[ind[0]] == hkstack.h0
+    assert k[ind[1]] == hkstack.k0
+
+    hkstack.bootstrap(nboot=20, typ='sum', vp=6.3, seed=0)
+    assert hkstack.ci_h0[0] <= hkstack.h0 <= hkstack.ci_h0[1]
+    assert hkstack.ci_k0[0] <= hkstack.k0 <= hkstack.ci_k0[1]
+
+
+def test_adaptive_grid():
+    rfV = _synthetic_stream(ntr=6, npts=201)
+    dense = _hkstack(rfV.copy())
+    dense.dh = 0.5
+    dense.dk = 0.02
+    dense.stack()
+    adaptive = _hkstack(rfV.copy())
+    adaptive.dh = 0.5
+    adaptive.dk = 0.02
+    adaptive.stack(adaptive=True, ncoarse=3)
+
+    # Fewer nodes are evaluated, exactly, around the maxima
+    nnode = dense.pws.shape[0]*dense.pws.shape[1]
+    assert dense.neval == nnode
+    assert adaptive.neval == adaptive.exact.sum() < nnode
+    assert np.allclose(adaptive.pws[adaptive.exact],
+                       dense.pws[adaptive.exact])
+    for typ in ['sum', 'product']:
+        dense.average(typ=typ)
+        adaptive.average(typ=typ)
+        assert dense.h0 == adaptive.h0
+        assert dense.k0 == adaptive.k0
+        assert dense.err_h0 == adaptive.err_h0
+        assert dense.err_k0 == adaptive.err_k0
+
+    # A later dense stack resets the number of exact nodes (the method
+    # is shadowed by the final stack of average)
+    HkStack.stack(adaptive)
+    assert adaptive.neval == nnode
+    assert adaptive.exact.all()
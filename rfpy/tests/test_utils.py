@@ -0,0 +1,30 @@
+import numpy as np
+from rfpy import utils
+
+
+def _scaled(x):
+    return utils.SHARED['scale']*x
+
+
+def test_pool_imap():
+    items = list(range(7))
+    serial = list(utils.pool_imap(_scaled, items, 1, {'scale': 3}))
+    pooled = list(utils.pool_imap(_scaled, items, 2, {'scale': 3}))
+    assert serial == pooled == [3*x for x in items]
+
+
+def test_resample_errors():
+    x = np.random.default_rng(0).normal(size=30)
+
+    idx = utils.resample_indices(len(x), method='jackknife')
+    assert idx.shape == (30, 29)
+    err, ci = utils.resample_errors(x[idx].mean(axis=1), len(x),
+                                    method='jackknife')
+    # The jackknife standard error of the mean is the usual one
+    assert np.isclose(err, np.std(x, ddof=1)/np.sqrt(len(x)))
+    assert ci[0] < x.mean() < ci[1]
+
+    idx = utils.resample_indices(len(x), nboot=500, seed=0)
+    assert idx.shape == (500, 30)
+    err, ci = utils.resample_errors(x[idx].mean(axis=1), len(x))
+    assert ci[0] < x.mean() < ci[1]
@@ -582,3 +582,109 @@ def download_data(client=None, sta=None, start=UTCDateTime, end=UTCDateTime,
         else:
             print("* Waveforms Retrieved...")
             return False, st
+
+
+# Data shared with the functions mapped by pool_imap
+SHARED = {}
+
+
+def share(data):
+    """
+    Function to make the dictionary ``data`` available as ``SHARED`` to
+    the functions mapped by :func:`~rfpy.utils.pool_imap`
+
+    """
+
+    SHARED.clear()
+    SHARED.update(data)
+
+
+def pool_imap(func, items, nproc=1, shared=None):
+    """
+    Generator of ``func(item)`` for each of ``items`` in turn, evaluated in
+    ``nproc`` worker processes if ``nproc > 1``. The dictionary ``shared``
+    is sent once to each worker, rather than with every item, and is
+    available to ``func`` as ``SHARED``.
+
+    Parameters
+    ----------
+    func : function
+        Module-level function of a single item
+    items : list
+        Items to map ``func`` over
+    nproc : int
+        Number of processes
+    shared : dict
+        Data shared by all items
+
+    """
+
+    if shared is None:
+        shared = {}
+
+    if nproc > 1 and len(items) > 1:
+        from multiprocessing import Pool
+        with Pool(min(nproc, len(items)), initializer=share,
+                  initargs=(shared,)) as pool:
+            for result in pool.imap(func, items):
+                yield result
+    else:
+        share(shared)
+        for item in items:
+            yield func(item)
+
+
+def resample_indices(n, nboot=200, method='bootstrap', seed=None):
+    """
+    Function to draw the indices of the data in each resample of ``n``
+    data, for the bootstrap (``nboot`` random draws of ``n`` indices with
+    replacement) or the jackknife (``n`` resamples, leaving each index
+    out in turn).
+
+    Returns
+    -------
+    idx : :class:`~numpy.ndarray`
+        Indices of the data in each resample (one resample per row)
+
+    """
+
+    if method == 'bootstrap':
+        rng = np.random.default_rng(seed)
+        return rng.integers(0, n, size=(nboot, n))
+    elif method == 'jackknife':
+        return np.array([np.delete(np.arange(n), i) for i in range(n)])
+    else:
+        raise(Exception("'method' must be either 'bootstrap' or " +
+                        "'jackknife'"))
+
+
+def resample_errors(samples, n, method='bootstrap', q=0.05):
+    """
+    Function to obtain the standard errors and ``1 - q`` confidence
+    intervals of estimates from their values over resamples of ``n``
+    data (along the first axis of ``samples``). Bootstrap intervals are
+    given by the quantiles of the resamples, and jackknife intervals by
+    the Student t distribution with ``n - 1`` degrees of freedom.
+
+    Returns
+    -------
+    err : :class:`~numpy.ndarray`
+        Standard errors
+    ci : :class:`~numpy.ndarray`
+        Lower and upper bounds of the confidence intervals (first axis)
+
+    """
+
+    samples = np.asarray(samples, dtype=float)
+
+    if method == 'bootstrap':
+        err = np.std(samples, axis=0, ddof=1)
+        ci = np.quantile(samples, [q/2., 1. - q/2.], axis=0)
+    else:
+        from scipy import stats
+        mean = np.mean(samples, axis=0)
+        err = np.sqrt((n - 1.)*np.mean((samples - mean)**2, axis=0))
+        tq = stats.t.ppf(1. - q/2., n - 1)
+        ci = np.array([mean - tq*err, mean + tq*err])
+
+    return err, ci